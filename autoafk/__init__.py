@@ -3,12 +3,18 @@ from __future__ import annotations
 from typing import TYPE_CHECKING
 
 if TYPE_CHECKING:
-    from typing import Dict
+    from typing import Callable, Dict, Hashable, List
     from mello.utils.plugins.context import Context
     from mello.utils.plugins.user import ContextUser
     from mello.utils.plugins.channels import ContextChannel
 
-from threading import Timer
+import traceback
+from array import array
+from collections import deque
+from heapq import heapify, heappop, heappush
+from itertools import count
+from threading import Condition, Lock, Thread
+from time import monotonic
 
 from mello.utils.plugins import Command, Plugin
 
@@ -17,11 +23,185 @@ from mello.utils.plugins.message import Colors
 from mello.utils.plugins.web.options.number_option import NumberOption
 
 
+class Scheduler:
+    def __init__(self):
+        self.queue: list[tuple[float, int, Hashable]] = []
+        self.jobs: Dict[Hashable, tuple[int, Callable, tuple]] = {}
+        self.counter = count()
+        self.condition = Condition()
+        self.thread: Thread | None = None
+
+    def schedule(self, key: Hashable, delay: float, function: Callable, *args):
+        with self.condition:
+            seq = next(self.counter)
+            self.jobs[key] = (seq, function, args)
+            heappush(self.queue, (monotonic() + delay, seq, key))
+            if len(self.queue) > 2 * len(self.jobs) + 64:
+                # Cancelled entries are dropped lazily, rebuild before they outnumber the live ones
+                self.queue = [entry for entry in self.queue if self._live(entry)]
+                heapify(self.queue)
+            if self.thread is None:
+                self.thread = Thread(target=self.run, name="AutoAFK", daemon=True)
+                self.thread.start()
+            self.condition.notify()
+
+    def cancel(self, key: Hashable) -> bool:
+        with self.condition:
+            return self.jobs.pop(key, None) is not None
+
+    def _live(self, entry: tuple[float, int, Hashable]) -> bool:
+        job = self.jobs.get(entry[2])
+        return job is not None and job[0] == entry[1]
+
+    def run(self):
+        while True:
+            with self.condition:
+                while True:
+                    if not self.queue:
+                        self.condition.wait()
+                    elif not self._live(self.queue[0]):
+                        heappop(self.queue)
+                    elif self.queue[0][0] > monotonic():
+                        self.condition.wait(self.queue[0][0] - monotonic())
+                    else:
+                        break
+                _, _, key = heappop(self.queue)
+                _, function, args = self.jobs.pop(key)
+            try:
+                function(*args)
+            except Exception:
+                traceback.print_exc()
+
+
+class Deadlines:
+    # Deadlines packed in an array for the sweep, removal swaps the last entry into the freed slot
+    def __init__(self):
+        self.deadlines = array("d")
+        self.ids: list[str] = []
+        self.users: list[ContextUser] = []
+        self.index: Dict[str, int] = {}
+        self.lock = Lock()
+
+    def __len__(self):
+        return len(self.ids)
+
+    def add(self, user: ContextUser, deadline: float):
+        with self.lock:
+            _id = user.id()
+            i = self.index.get(_id)
+            if i is None:
+                self.index[_id] = len(self.ids)
+                self.deadlines.append(deadline)
+                self.ids.append(_id)
+                self.users.append(user)
+            else:
+                self.deadlines[i] = deadline
+                self.users[i] = user
+
+    def remove(self, _id: str) -> bool:
+        with self.lock:
+            return self._remove(_id)
+
+    def _remove(self, _id: str) -> bool:
+        i = self.index.pop(_id, None)
+        if i is None:
+            return False
+        last = len(self.ids) - 1
+        if i != last:
+            self.deadlines[i] = self.deadlines[last]
+            self.ids[i] = self.ids[last]
+            self.users[i] = self.users[last]
+            self.index[self.ids[i]] = i
+        self.deadlines.pop()
+        self.ids.pop()
+        self.users.pop()
+        return True
+
+    def expired(self, now: float) -> List[ContextUser]:
+        with self.lock:
+            expired = [self.users[i] for i, deadline in enumerate(self.deadlines) if deadline <= now]
+            for user in expired:
+                self._remove(user.id())
+            return expired
+
+    def drain(self) -> List[tuple[ContextUser, float]]:
+        with self.lock:
+            pending = list(zip(self.users, self.deadlines))
+            self.deadlines = array("d")
+            self.ids.clear()
+            self.users.clear()
+            self.index.clear()
+            return pending
+
+
+# Outbound actions, the value is also the priority: restores are served before AFK moves
+RESTORE = 0
+AFK = 1
+# Server calls made by each action (an AFK move also sends a DM)
+COSTS = (1, 2)
+
+
+class MoveQueue:
+    # Token bucket rate limited queue, holding at most one pending action per user
+    def __init__(self, rate: float):
+        self.rate = rate
+        self.tokens = rate
+        self.stamp = monotonic()
+        self.pending: Dict[str, tuple[int, ContextUser, ContextChannel | None]] = {}
+        self.queues = (deque(), deque())
+        self.lock = Lock()
+
+    def __len__(self):
+        return len(self.pending)
+
+    def push(self, action: int, user: ContextUser, channel: ContextChannel | None = None):
+        with self.lock:
+            _id = user.id()
+            if _id not in self.pending:
+                self.queues[action].append(_id)
+            self.pending[_id] = (action, user, channel)
+
+    def cancel(self, _id: str, action: int) -> tuple[int, ContextUser, ContextChannel | None] | None:
+        with self.lock:
+            pending = self.pending.get(_id)
+            if pending is None or pending[0] != action:
+                return None
+            # The ID stays in its deque and is skipped when popped
+            return self.pending.pop(_id)
+
+    def pop(self) -> tuple[tuple[int, ContextUser, ContextChannel | None] | None, float]:
+        # Returns the next action allowed to run now, or the seconds to wait for enough tokens
+        with self.lock:
+            now = monotonic()
+            # Room for the most expensive action even at the lowest rate, or it would never run
+            self.tokens = min(max(self.rate, max(COSTS)), self.tokens + (now - self.stamp) * self.rate)
+            self.stamp = now
+            for action, queue in enumerate(self.queues):
+                while queue:
+                    pending = self.pending.get(queue[0])
+                    if pending is None or pending[0] != action:
+                        queue.popleft()
+                        continue
+                    cost = COSTS[action]
+                    if self.tokens < cost:
+                        return None, (cost - self.tokens) / self.rate
+                    self.tokens -= cost
+                    queue.popleft()
+                    return self.pending.pop(pending[1].id()), 0.0
+            return None, 0.0
+
+
+SWEEP = ("sweep",)  # Scheduler keys of the sweep and queue jobs, can't collide with a user ID
+PUMP = ("pump",)
+
+
 class AutoAfkPlugin(Plugin):
     def __init__(self):
         super().__init__("autoafk", "AutoAFK", "Check periodically if an user quit the audio and move it into the AFK channel", ["nico9889"])
         self.previous_channels: Dict[str, ContextChannel] = {}
-        self.timers: Dict[str, Timer] = {}
+        self.scheduler = Scheduler()
+        self.deadlines = Deadlines()
+        self.moves = MoveQueue(5)
         self.channel: ContextChannel | None = None
         self.add_command(SetAfkTimeCommand(self))
         self.add_command(SetAfkChannelCommand(self))
@@ -32,12 +212,26 @@ class AutoAfkPlugin(Plugin):
         self.time_option = NumberOption("AFK Time", "Seconds that has to elapse before moving the user", 15, 0, 60, 1)
         self.time_option.on_change = lambda value: setattr(self, "time", value if value > 0 else 0) or value > 0
         self.options.add(self.time_option)
+        self.sweep_option = NumberOption("Sweep interval",
+                                         "If greater than 0, deafened users are collected and moved in batches every "
+                                         "n seconds instead of one by one", 0, 0, 60, 1)
+        self.sweep_option.on_change = lambda value: self.set_sweep(int(value) if value > 0 else 0) or True
+        self.options.add(self.sweep_option)
+        self.rate_option = NumberOption("Move rate", "Maximum number of moves and messages per second sent by the "
+                                                     "plugin. Restores are served before AFK moves.", 5, 1, 50, 1)
+        self.rate_option.on_change = lambda value: setattr(self, "rate", int(value) if value > 0 else 1) or value > 0
+        self.options.add(self.rate_option)
 
     def on_load(self, ctx: Context):
         channel_id = self.instance_storage.get("channel")
         if channel_id:
             self.channel = ctx.channels.get(channel_id)
         self.time_option.set(self.time)
+        self.sweep_option.set(self.sweep)
+        self.rate_option.set(self.rate)
+        self.moves.rate = self.rate
+        if self.sweep:
+            self.scheduler.schedule(SWEEP, self.sweep, self.sweep_expired)
 
     @property
     def time(self):
@@ -47,6 +241,77 @@ class AutoAfkPlugin(Plugin):
     def time(self, value):
         self.instance_storage["time"] = value
 
+    @property
+    def sweep(self) -> int:
+        return self.instance_storage.get("sweep") or 0
+
+    @sweep.setter
+    def sweep(self, value: int):
+        self.instance_storage["sweep"] = value
+
+    def set_sweep(self, interval: int):
+        self.sweep = interval
+        if interval:
+            self.scheduler.schedule(SWEEP, interval, self.sweep_expired)
+        else:
+            self.scheduler.cancel(SWEEP)
+            # Back to per user deadlines, hand over the ones collected so far
+            now = monotonic()
+            for user, deadline in self.deadlines.drain():
+                self.scheduler.schedule(user.id(), max(0.0, deadline - now), self.expire, user)
+
+    def sweep_expired(self):
+        for user in self.deadlines.expired(monotonic()):
+            self.expire(user)
+        if self.sweep:
+            self.scheduler.schedule(SWEEP, self.sweep, self.sweep_expired)
+
+    @property
+    def rate(self) -> int:
+        return self.instance_storage.get("rate") or 5
+
+    @rate.setter
+    def rate(self, value: int):
+        self.instance_storage["rate"] = value
+        self.moves.rate = value
+
+    def expire(self, user: ContextUser):
+        restore = self.moves.cancel(user.id(), RESTORE)
+        if restore:
+            # Deafened again before being moved back: the user never left the AFK channel
+            self.previous_channels[user.id()] = restore[2]
+            return
+        self.moves.push(AFK, user)
+        self.scheduler.schedule(PUMP, 0, self.pump)
+
+    def restore(self, user: ContextUser):
+        if self.moves.cancel(user.id(), AFK):
+            # Still waiting for the AFK move, nothing to undo
+            return
+        try:
+            channel = self.previous_channels.pop(user.id())
+        except KeyError:
+            return
+        self.moves.push(RESTORE, user, channel)
+        self.scheduler.schedule(PUMP, 0, self.pump)
+
+    def pump(self):
+        while True:
+            pending, wait = self.moves.pop()
+            if pending is None:
+                if wait:
+                    self.scheduler.schedule(PUMP, wait, self.pump)
+                return
+            action, user, channel = pending
+            # A user that has gone away must not hold up the rest of the queue
+            try:
+                if action == AFK:
+                    self.afk(user)
+                else:
+                    user.move(channel)
+            except Exception:
+                traceback.print_exc()
+
     @property
     def enabled(self):
         return self.instance_storage.get("enabled") or False
@@ -60,25 +325,18 @@ class AutoAfkPlugin(Plugin):
         user.send_message(f"You were moved because you were muted for more than {self.time} seconds.\n"
                           f"Unmute to get back to the previous channel!")
         user.move(self.channel)
-        self.timers.pop(user.id())
 
     def on_deafen_change(self, ctx: Context, deaf: bool, actor):
         if self.channel and self.enabled:
             if deaf:
-                t = Timer(interval=self.time, function=self.afk, args=[ctx.user, ])
-                self.timers[ctx.user.id()] = t
-                t.start()
+                if self.sweep:
+                    self.deadlines.add(ctx.user, monotonic() + self.time)
+                else:
+                    self.scheduler.schedule(ctx.user.id(), self.time, self.expire, ctx.user)
             else:
-                try:
-                    channel = self.previous_channels.pop(ctx.user.id())
-                    ctx.user.move(channel)
-                except KeyError:
-                    pass
-                try:
-                    t = self.timers.pop(ctx.user.id())
-                    t.cancel()
-                except KeyError:
-                    pass
+                self.restore(ctx.user)
+                if not self.deadlines.remove(ctx.user.id()):
+                    self.scheduler.cancel(ctx.user.id())
 
 
 plugin = AutoAfkPlugin
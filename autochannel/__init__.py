@@ -2,23 +2,23 @@ from __future__ import annotations
 from typing import TYPE_CHECKING
 
 if TYPE_CHECKING:
+    from typing import Dict
     from mello.utils.plugins.context import Context
     from mello.utils.plugins.channels import ContextChannel
     from mello.utils.plugins.user import ContextUser
 
+from heapq import heappop, heappush
+from threading import Lock, Timer
+
 from mello.utils.plugins import Plugin, Command
 from mello.utils.plugins.callbacks import Callback
 from mello.utils.plugins.message import Colors
+from mello.utils.plugins.web.options.number_option import NumberOption
 
 
-def check_empty(ctx: Context, parent: ContextChannel, name: str):
-    empty = False
-    children = parent.children()
-    for channel in children:
-        empty = empty or (len(channel.users()) == 0)
-    if empty:
-        return
-    ctx.channels.new(f"{name} #{len(children) + 1}", parent)
+def number(name: str) -> int | None:
+    _, separator, suffix = name.rpartition(" #")
+    return int(suffix) if separator and suffix.isdigit() else None
 
 
 def clear_empty(channel: ContextChannel):
@@ -30,12 +30,140 @@ def clear_empty(channel: ContextChannel):
             child.delete()
 
 
+class Occupancy:
+    # Users per child of a magic channel, kept up to date from the move events
+    def __init__(self, parent: ContextChannel, first: str | None):
+        self.parent = parent
+        self.first = first
+        self.children: Dict[str, ContextChannel] = {}
+        self.users: Dict[str, int] = {}
+        self.empty: set[str] = set()
+        # Numbers used in the children names, freed ones are handed out again lowest first
+        self.numbers: Dict[str, int] = {}
+        self.taken: set[int] = set()
+        self.free: list[int] = []
+        self.next = 1
+        # Numbers handed out for channels still being created
+        self.reserved: set[int] = set()
+
+    def add(self, child: ContextChannel, users: int = 0, number: int | None = None):
+        self.children[child.id()] = child
+        self.users[child.id()] = users
+        if not users:
+            self.empty.add(child.id())
+        if number in self.reserved:
+            self.reserved.discard(number)
+            self.numbers[child.id()] = number
+        elif number is not None and number not in self.taken:
+            self.numbers[child.id()] = number
+            self.taken.add(number)
+            if number >= self.next:
+                for free in range(self.next, number):
+                    heappush(self.free, free)
+                self.next = number + 1
+
+    def remove(self, child_id: str):
+        self.children.pop(child_id, None)
+        self.users.pop(child_id, None)
+        self.empty.discard(child_id)
+        number = self.numbers.pop(child_id, None)
+        if number is not None:
+            self.taken.discard(number)
+            heappush(self.free, number)
+
+    def allocate(self) -> int:
+        number = None
+        while self.free:
+            free = heappop(self.free)
+            # Taken in the meantime by a channel created by someone else
+            if free not in self.taken:
+                number = free
+                break
+        if number is None:
+            number = self.next
+            self.next += 1
+        self.taken.add(number)
+        self.reserved.add(number)
+        return number
+
+    def release(self, number: int):
+        # A reserved number whose channel was never created
+        self.reserved.discard(number)
+        self.taken.discard(number)
+        heappush(self.free, number)
+
+    def join(self, child_id: str):
+        users = self.users.get(child_id)
+        if users is not None:
+            self.users[child_id] = users + 1
+            self.empty.discard(child_id)
+
+    def leave(self, child_id: str):
+        users = self.users.get(child_id)
+        if users:
+            self.users[child_id] = users - 1
+            if users == 1:
+                self.empty.add(child_id)
+
+
 class AutoChannel(Plugin):
     def __init__(self):
         super().__init__("autochannel", "AutoChannel", "Create channels automagically", ["nico9889"])
+        self.names: Dict[str, str] = {}
+        self.parents: Dict[str, str] = {}
+        self.occupancy: Dict[str, Occupancy] = {}
+        self.user_channels: Dict[str, tuple[str, str]] = {}
+        self.timers: Dict[str, Timer] = {}
+        self.trim_timers: Dict[str, Timer] = {}
+        self.lock = Lock()
         self.add_command(ApplyMagic(self))
         self.add_command(RemoveMagic(self))
         self.set_callback(Callback.OnUserMoved, self.on_user_moved)
+        self.set_callback(Callback.OnUserJoinServer, self.on_user_joined)
+        self.set_callback(Callback.OnUserLeaveServer, self.on_user_leaved)
+
+    def on_load(self, ctx: Context):
+        # Read once, the commands keep it in sync with the storage
+        self.names = dict(self.channels)
+        debounce_option = NumberOption("Debounce", "Milliseconds to wait after a move before creating or deleting "
+                                                   "channels, moves in the meantime are handled together",
+                                       self.debounce, 0, 10000, 100)
+        spares_option = NumberOption("Spare channels", "Empty channels kept ready in every magic channel",
+                                     self.spares, 1, 20, 1)
+        trim_delay_option = NumberOption("Trim delay", "Seconds that extra empty channels are kept before being "
+                                                       "deleted", self.trim_delay, 0, 3600, 1)
+        debounce_option.on_change = lambda value: setattr(self, "debounce", int(value)) or True
+        spares_option.on_change = lambda value: setattr(self, "spares", int(value)) or True
+        trim_delay_option.on_change = lambda value: setattr(self, "trim_delay", int(value)) or True
+        self.options.add(debounce_option)
+        self.options.add(spares_option)
+        self.options.add(trim_delay_option)
+
+    @property
+    def debounce(self) -> int:
+        debounce = self.instance_storage.get("debounce")
+        return 1000 if debounce is None else debounce
+
+    @debounce.setter
+    def debounce(self, debounce: int):
+        self.instance_storage["debounce"] = debounce
+
+    @property
+    def spares(self) -> int:
+        return self.instance_storage.get("spares") or 1
+
+    @spares.setter
+    def spares(self, spares: int):
+        self.instance_storage["spares"] = spares
+
+    @property
+    def trim_delay(self) -> int:
+        trim_delay = self.instance_storage.get("trim_delay")
+        return 60 if trim_delay is None else trim_delay
+
+    @trim_delay.setter
+    def trim_delay(self, trim_delay: int):
+        self.instance_storage["trim_delay"] = trim_delay
 
     @property
     def channels(self) -> dict[str, str]:
@@ -45,21 +173,154 @@ class AutoChannel(Plugin):
     def channels(self, channels: dict[str, str]):
         self.instance_storage["channels"] = channels
 
-    def on_user_moved(self, ctx: Context, channel: ContextChannel, actor: ContextUser):
+    def get_occupancy(self, parent: ContextChannel) -> Occupancy:
+        try:
+            return self.occupancy[parent.id()]
+        except KeyError:
+            # Counted once, then only updated from the events
+            children = parent.children()
+            occupancy = Occupancy(parent, children[0].id() if children else None)
+            numbers = [number(child.name()) for child in children]
+            if numbers and numbers[0] is None and 1 not in numbers:
+                # The first channel usually comes without a number, it's the #1 anyway
+                numbers[0] = 1
+            for child, child_number in zip(children, numbers):
+                users = child.users()
+                occupancy.add(child, len(users), child_number)
+                self.parents[child.id()] = parent.id()
+                for user in users:
+                    self.user_channels[user.id()] = (parent.id(), child.id())
+            self.occupancy[parent.id()] = occupancy
+            return occupancy
+
+    def mark(self, ctx: Context, parent_id: str):
+        # One pending reconcile per parent, whatever the number of moves until it runs
+        timer = self.timers.get(parent_id)
+        occupancy = self.occupancy.get(parent_id)
+        if occupancy is not None and not occupancy.empty:
+            # The spares are gone, top up at once
+            if timer:
+                timer.cancel()
+            delay = 0
+        elif timer:
+            return
+        else:
+            delay = self.debounce / 1000
+        timer = Timer(delay, self.reconcile, [ctx, parent_id])
+        timer.daemon = True
+        self.timers[parent_id] = timer
+        timer.start()
+
+    def reconcile(self, ctx: Context, parent_id: str):
+        # Planned and recorded under the lock, the server calls run without it so the events aren't held up
+        with self.lock:
+            self.timers.pop(parent_id, None)
+            occupancy = self.occupancy.get(parent_id)
+            name = self.names.get(parent_id)
+            if not occupancy or not name:
+                return
+            # Channels still being created by another pass count as spares
+            missing = self.spares - len(occupancy.empty) - len(occupancy.reserved)
+            numbers = [occupancy.allocate() for _ in range(missing)]
+            if missing < 0 and parent_id not in self.trim_timers:
+                # Extra spares are deleted later, if still unused: a new wave of users may need them
+                timer = Timer(self.trim_delay, self.trim, [parent_id])
+                timer.daemon = True
+                self.trim_timers[parent_id] = timer
+                timer.start()
+        created = []
         try:
+            for child_number in numbers:
+                child = ctx.channels.new(f"{name} #{child_number}", occupancy.parent)
+                if not child:
+                    break
+                created.append((child_number, child))
+        finally:
+            # Also when the server call raises, or the reserved numbers would count as spares forever
+            with self.lock:
+                for child_number, child in created:
+                    # A user may have joined it already, then it has been recorded by the join
+                    if child.id() not in occupancy.children:
+                        occupancy.add(child, number=child_number)
+                        self.parents[child.id()] = parent_id
+                for child_number in numbers[len(created):]:
+                    occupancy.release(child_number)
+                if len(created) < len(numbers) and self.occupancy.get(parent_id) is occupancy:
+                    # Can't track a channel we don't have, count again on the next move
+                    self.forget(parent_id)
+
+    def trim(self, parent_id: str):
+        with self.lock:
+            self.trim_timers.pop(parent_id, None)
+            occupancy = self.occupancy.get(parent_id)
+            if not occupancy:
+                return
+            # Never delete the first child, the highest numbers go first
+            surplus = sorted((child_id for child_id in occupancy.empty if child_id != occupancy.first),
+                             key=lambda child_id: occupancy.numbers.get(child_id, 0), reverse=True)
+            deleted = []
+            for child_id in surplus[:len(occupancy.empty) - self.spares]:
+                deleted.append(occupancy.children[child_id])
+                occupancy.remove(child_id)
+                self.parents.pop(child_id, None)
+        for child in deleted:
+            child.delete()
+
+    def forget(self, parent_id: str):
+        occupancy = self.occupancy.pop(parent_id, None)
+        if occupancy:
+            for child_id in occupancy.children:
+                self.parents.pop(child_id, None)
+
+    def leave(self, ctx: Context, user: ContextUser):
+        previous = self.user_channels.pop(user.id(), None)
+        if not previous:
+            return
+        parent_id, child_id = previous
+        occupancy = self.occupancy.get(parent_id)
+        if occupancy and parent_id in self.names:
+            occupancy.leave(child_id)
+            self.mark(ctx, parent_id)
+
+    def join(self, ctx: Context, user: ContextUser, channel: ContextChannel):
+        if channel.id() in self.names:
+            self.get_occupancy(channel)
+            self.mark(ctx, channel.id())
+            return
+        parent_id = self.parents.get(channel.id())
+        if parent_id is not None:
+            occupancy = self.occupancy[parent_id]
+        else:
+            # Not indexed yet: a magic channel never counted or a child created by someone else
             parent = channel.parent()
-            if not parent:
+            if not parent or parent.id() not in self.names:
                 return
-            name = self.channels[parent.id()]
-            clear_empty(parent)
-            check_empty(ctx, parent, name)
-        except KeyError:
-            try:
-                name = self.channels[channel.id()]
-                clear_empty(channel)
-                check_empty(ctx, channel, name)
-            except KeyError:
-                pass
+            parent_id = parent.id()
+            occupancy = self.get_occupancy(parent)
+            if channel.id() not in occupancy.children:
+                occupancy.add(channel, number=number(channel.name()))
+                self.parents[channel.id()] = parent_id
+        location = (parent_id, channel.id())
+        # Already there if the channels have just been counted
+        if self.user_channels.get(user.id()) != location:
+            occupancy.join(channel.id())
+            self.user_channels[user.id()] = location
+        self.mark(ctx, parent_id)
+
+    def on_user_moved(self, ctx: Context, channel: ContextChannel, actor: ContextUser):
+        with self.lock:
+            self.leave(ctx, ctx.user)
+            self.join(ctx, ctx.user, channel)
+
+    def on_user_joined(self, ctx: Context):
+        channel = ctx.user.current_channel()
+        if channel:
+            with self.lock:
+                self.join(ctx, ctx.user, channel)
+
+    def on_user_leaved(self, ctx: Context):
+        with self.lock:
+            self.leave(ctx, ctx.user)
 
 
 class ApplyMagic(Command):
@@ -84,7 +345,11 @@ class ApplyMagic(Command):
         channels = self.plugin.channels
         channels[channel.id()] = name
         self.plugin.channels = channels
-        check_empty(ctx, channel, name)
+        with self.plugin.lock:
+            self.plugin.names[channel.id()] = name
+            self.plugin.forget(channel.id())
+            self.plugin.get_occupancy(channel)
+            self.plugin.mark(ctx, channel.id())
 
 
 class RemoveMagic(Command):
@@ -98,6 +363,9 @@ class RemoveMagic(Command):
             channels = self.plugin.channels
             del channels[channel.id()]
             self.plugin.channels = channels
+            with self.plugin.lock:
+                self.plugin.names.pop(channel.id(), None)
+                self.plugin.forget(channel.id())
             clear_empty(channel)
             ctx.message.text("This channel is now normal again").reply_to_channel()
         except KeyError:
@@ -1,10 +1,13 @@
 from __future__ import annotations
 
+import os
 import re
+from concurrent.futures import ProcessPoolExecutor
+from threading import Thread
 from typing import TYPE_CHECKING
 
 if TYPE_CHECKING:
-    from typing import Callable
+    from typing import Callable, Tuple
     from mello.utils.plugins.context import Context
     from mello.utils.plugins.media import ContextTrack
 
@@ -13,6 +16,28 @@ from mello.utils.plugins import Plugin, Command
 from mello.utils.plugins.callbacks import Callback
 from mello.utils.plugins.message import Colors, ContextMessage
 
+# Track projection shipped to the scan workers: (id, duration, author, uploader, title), text fields lowercased
+ROW_FIELDS = {"duration": 1, "author": 2, "uploader": 3, "title": 4}
+
+
+def project(track: ContextTrack) -> tuple:
+    return (track.id, track.duration, track.author.lower(), track.uploader.name.lower(),
+            track.normalized_title.lower())
+
+
+def evaluate_partition(rules: List[tuple], rows: List[tuple]) -> List[Tuple[int, int]]:
+    hits = []
+    for row in rows:
+        for negative, field, value, playlists in rules:
+            if field == 1:
+                matched = row[1] < value
+            else:
+                matched = value in row[field]
+            if matched != negative:
+                for _id in playlists:
+                    hits.append((row[0], _id))
+    return hits
+
 
 class Filter:
     def __init__(self, negative: bool, _filter: str, keyword: str):
@@ -51,6 +76,11 @@ class Filter:
     def __repr__(self):
         return self.__str__()
 
+    def compile(self, playlists: list[int]) -> tuple:
+        field = ROW_FIELDS[self.filter]
+        value = int(self.keyword) if field == 1 else self.keyword
+        return self.negative, field, value, playlists
+
     def as_dict(self):
         return {
             "negative": self.negative,
@@ -123,6 +153,58 @@ class AutoPlayList(Plugin):
         except Exception as e:
             ctx.message.text(str(e), color=Colors.RED).reply_to_channel()
 
+    def backfill(self, ctx: Context, filter_: Filter, playlist_id: int):
+        try:
+            playlist = ctx.media.playlists[playlist_id]
+        except KeyError:
+            return
+        try:
+            # Tracks already in the playlist are never re-evaluated
+            present = {track.id for track in playlist.get_tracks()}
+            added = 0
+            for track in ctx.media.tracks():
+                if track.id not in present and filter_.apply(track):
+                    playlist.add_track(track.id)
+                    present.add(track.id)
+                    added += 1
+            ctx.message.bold("AutoPlayList: ").text(f"backfill of {filter_} added {added} tracks to ") \
+                .bold(playlist.name).reply_to_channel()
+        except Exception as e:
+            ctx.message.text(str(e), color=Colors.RED).reply_to_channel()
+
+    def parallel_scan(self, ctx: Context, workers: int):
+        rules = [Filter.from_str(keyword).compile(playlists) for keyword, playlists in self.keywords.items()]
+        rows = [project(track) for track in ctx.media.tracks()]
+        if not rules or not rows:
+            return 0
+        # A few partitions per worker keep the pool busy when partitions take uneven time
+        size = max(1, -(-len(rows) // (workers * 4)))
+        partitions = [rows[i:i + size] for i in range(0, len(rows), size)]
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            results = list(executor.map(evaluate_partition, [rules] * len(partitions), partitions))
+
+        playlists = {}
+        for _, _, _, ids in rules:
+            for _id in ids:
+                if _id in playlists:
+                    continue
+                try:
+                    playlists[_id] = ctx.media.playlists[_id]
+                except KeyError:
+                    ctx.message.text(f"AutoPlayList: playlist ID {_id} not found",
+                                     color=Colors.RED).reply_to_channel()
+        present = {_id: {track.id for track in playlist.get_tracks()} for _id, playlist in playlists.items()}
+
+        added = 0
+        for hits in results:
+            for track_id, _id in hits:
+                tracks = present.get(_id)
+                if tracks is not None and track_id not in tracks:
+                    playlists[_id].add_track(track_id)
+                    tracks.add(track_id)
+                    added += 1
+        return added
+
 
 class Keywords(Command):
     def __init__(self, autoplaylist: AutoPlayList):
@@ -170,8 +252,9 @@ class AddKeyWord(Command):
             except KeyError:
                 keywords[str(filter_)] = [playlist_id]
             self.plugin.keywords = keywords
-            return ctx.message.text("Added keyword ").bold(chunks[1]).text(" for playlist ").bold(
+            ctx.message.text("Added keyword ").bold(chunks[1]).text(" for playlist ").bold(
                 playlist.name).reply_to_channel()
+            Thread(target=self.plugin.backfill, args=[ctx, filter_, playlist_id], daemon=True).start()
         except Exception as e:
             return ctx.message.text(str(e), color=Colors.RED).reply_to_channel()
 
@@ -204,10 +287,21 @@ class Playlists(Command):
 
 class ScanExistent(Command):
     def __init__(self, autoplaylist: AutoPlayList):
-        super().__init__("scanexistent", "Scan existent tracks")
+        super().__init__("scanexistent", "Scan existent tracks. Use !scanexistent parallel [workers] to use "
+                                         "multiple processes")
         self.plugin = autoplaylist
 
     def execute(self, ctx: Context, message: str):
+        chunks = message.split()
+        if chunks and chunks[0] == "parallel":
+            workers = int(chunks[1]) if len(chunks) > 1 and chunks[1].isdigit() else os.cpu_count() or 1
+            try:
+                added = self.plugin.parallel_scan(ctx, max(1, workers))
+                return ctx.message.bold("AutoPlaylist: ").text(f"scan terminated, {added} tracks added") \
+                    .reply_to_channel()
+            except Exception as e:
+                ctx.message.text(f"AutoPlayList: parallel scan failed ({e}), falling back to a sequential scan",
+                                 color=Colors.RED).reply_to_channel()
         tracks = ctx.media.tracks()
         for track in tracks:
             self.plugin.on_track_add(ctx, track)
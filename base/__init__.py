@@ -6,11 +6,120 @@ from mello.utils.plugins import DecoratorPlugin
 from mello.utils.plugins.message import MessageType
 
 if TYPE_CHECKING:
+    from typing import Callable, Dict, List
     from mello.utils.plugins.context import Context
 
+import traceback
+from threading import Lock
+
 plugin = DecoratorPlugin("base", "Base", "Base plugin supplied with the bot :D", ["nico9889"])
 
 
+class BoundContext:
+    # The Context of a message, seen with the storage and state of the plugin that registered the handler
+    def __init__(self, event: Context, owner: Context):
+        self._event = event
+        self._owner = owner
+
+    @property
+    def instance_storage(self):
+        return self._owner.instance_storage
+
+    @property
+    def state(self):
+        return self._owner.state
+
+    def __getattr__(self, name: str):
+        return getattr(self._event, name)
+
+
+class Node:
+    __slots__ = ("children", "exact", "prefix")
+
+    def __init__(self):
+        self.children: Dict[str, Node] = {}
+        self.exact: List[tuple[Callable, Context | None]] = []
+        self.prefix: List[tuple[Callable, Context | None]] = []
+
+
+class Dispatcher:
+    # Routes every chat message to the handlers registered for it, walking a trie of the patterns one character at
+    # a time: the cost depends on the message length, not on the number of plugins. One per bot instance, published
+    # in the shared storage as "dispatcher". A handler registered with the Context of its plugin gets the message
+    # Context bound to that plugin storage and state
+    def __init__(self):
+        self.root = Node()
+        self.lock = Lock()
+
+    def register(self, pattern: str, handler: Callable, ctx: Context | None = None, prefix: bool = False):
+        with self.lock:
+            node = self.root
+            for char in pattern:
+                node = node.children.setdefault(char, Node())
+            # Replaced, not mutated, so a dispatch in progress never sees a half updated list
+            if prefix:
+                node.prefix = node.prefix + [(handler, ctx)]
+            else:
+                node.exact = node.exact + [(handler, ctx)]
+
+    def unregister(self, pattern: str, handler: Callable):
+        with self.lock:
+            node = self.root
+            for char in pattern:
+                node = node.children.get(char)
+                if node is None:
+                    return
+            node.exact = [route for route in node.exact if route[0] != handler]
+            node.prefix = [route for route in node.prefix if route[0] != handler]
+
+    def match(self, msg: str) -> List[tuple[Callable, Context | None]]:
+        node = self.root
+        routes = list(node.prefix)
+        for char in msg:
+            node = node.children.get(char)
+            if node is None:
+                return routes
+            routes.extend(node.prefix)
+        routes.extend(node.exact)
+        return routes
+
+    def dispatch(self, ctx: Context, msg: str, _type: MessageType):
+        for handler, owner in self.match(msg):
+            # A failing handler doesn't stop the others
+            try:
+                handler(ctx if owner is None else BoundContext(ctx, owner), msg, _type)
+            except Exception:
+                traceback.print_exc()
+
+
+# Patterns of the Base handlers, registered in the dispatcher of every instance on load
+ROUTES: List[tuple[str, Callable, bool]] = []
+
+
+def message(pattern: str, prefix: bool = False):
+    def decorator(handler: Callable):
+        ROUTES.append((pattern, handler, prefix))
+        return handler
+
+    return decorator
+
+
+@plugin.state
+def create_state():
+    return {
+        "dispatcher": Dispatcher()
+    }
+
+
+@plugin.on_load
+def _on_load(ctx: Context):
+    dispatcher = ctx.state["dispatcher"]
+    for pattern, handler, prefix in ROUTES:
+        dispatcher.unregister(pattern, handler)
+        dispatcher.register(pattern, handler, prefix=prefix)
+    ctx.shared_storage["dispatcher"] = dispatcher
+
+
 # This is a placeholder, it's useful to describe internal command
 @plugin.command("register", "Register the current user to the platform")
 def register(_: Context, __: str):
@@ -37,7 +146,11 @@ def users(ctx: Context, _: str):
     m.reply_to_channel()
 
 
+@message("test")
+def test(ctx: Context, _: str, __: MessageType):
+    ctx.message.text("Toast!").reply_to_channel()
+
+
 @plugin.on_message
 def on_message(ctx: Context, msg: str, _type: MessageType):
-    if msg == "test":
-        ctx.message.text("Toast!").reply_to_channel()
+    ctx.state["dispatcher"].dispatch(ctx, msg, _type)
@@ -3,12 +3,17 @@ from __future__ import annotations
 from typing import TYPE_CHECKING
 
 if TYPE_CHECKING:
-    from typing import Dict
+    from typing import Callable, Dict, Iterable, List
     from mello.utils.plugins.context import Context
     from mello.utils.plugins.channels import ContextChannel
     from mello.utils.plugins.user import ContextUser
 
-from datetime import datetime, timedelta
+from bisect import bisect_left, insort
+import traceback
+from collections import OrderedDict, deque
+from itertools import count
+from threading import Condition, Thread
+from time import monotonic, sleep
 from mello.utils.plugins import Plugin, Command
 from mello.utils.plugins.callbacks import Callback
 from mello.utils.plugins.message import Colors
@@ -16,77 +21,381 @@ from mello.utils.plugins.web.options.number_option import NumberOption
 
 
 class KickCommand(Command):
-    def __init__(self):
-        super().__init__("kick", "Kick an user by username. You can specify a reason")
+    def __init__(self, plugin: CopPlugin):
+        super().__init__("kick", "Kick an user by username or by the start of the username. Separate more users "
+                                 "with commas. You can specify a reason")
+        self.plugin = plugin
 
     def execute(self, ctx: Context, message: str):
         message += " "
-        username, reason = message.split(" ", 1)
-        lower = str.lower
-        for user in ctx.users.values():
-            if lower(user.name()) == lower(username):
-                user.kick(reason)
+        usernames, reason = message.split(" ", 1)
+        users = self.plugin.targets(ctx, usernames)
+        if len(users) == 1:
+            users[0].kick(reason)
+        elif users:
+            self.plugin.executor.submit("kick", [(user.kick, (reason,)) for user in users], ctx)
 
 
 class BanCommand(Command):
-    def __init__(self):
-        super().__init__("ban", "Ban an user by username. You can specify a reason")
+    def __init__(self, plugin: CopPlugin):
+        super().__init__("ban", "Ban an user by username or by the start of the username. Separate more users "
+                                "with commas. You can specify a reason")
+        self.plugin = plugin
 
     def execute(self, ctx: Context, message: str):
         message += " "
-        username, reason = message.split(" ", 1)
-        lower = str.lower
-        for user in ctx.users.values():
-            if lower(user.name()) == lower(username):
-                user.ban(reason)
+        usernames, reason = message.split(" ", 1)
+        users = self.plugin.targets(ctx, usernames)
+        if len(users) == 1:
+            users[0].ban(reason)
+        elif users:
+            self.plugin.executor.submit("ban", [(user.ban, (reason,)) for user in users], ctx)
 
 
 class RageCommand(Command):
-    def __init__(self):
+    def __init__(self, plugin: CopPlugin):
         super().__init__("rage", "Someone got angry")
+        self.plugin = plugin
 
     def execute(self, ctx: Context, message: str):
-        author = ctx.user.name()
-        for user in ctx.users.values():
-            user.kick(f"{author} is very angry!")
+        reason = f"{ctx.user.name()} is very angry!"
+        self.plugin.executor.submit("rage", [(user.kick, (reason,)) for user in ctx.users.values()], ctx)
 
 
-class MoveMap:
-    def __init__(self, plugin: CopPlugin, user: ContextUser):
-        self.user = user
-        self.kick_counter: int = 0
-        self.static_counter: int = 0
-        self.dynamic_counter: int = 0
-        self.last_channel: ContextChannel = user.current_channel()
-        self.last_move = datetime.now()
+class Jobs(Command):
+    def __init__(self, plugin: CopPlugin):
+        super().__init__("jobs", "List the running moderation jobs")
+        self.plugin = plugin
+
+    def execute(self, ctx: Context, message: str):
+        jobs = self.plugin.executor.running()
+        if not jobs:
+            return ctx.message.text("No moderation job is running").reply_to_user()
+        li = ctx.message.bold("Moderation jobs:").list()
+        for job in jobs:
+            li.add(str(job))
+        li.close().reply_to_user()
+
+
+class Abort(Command):
+    def __init__(self, plugin: CopPlugin):
+        super().__init__("abort", "Abort a moderation job by number, or every job if no number is given")
         self.plugin = plugin
 
-    def check(self, destination: ContextChannel):
-        if datetime.now() < self.last_move + timedelta(seconds=self.plugin.move_time_limit):
-            if destination.id() == self.last_channel.id():
-                self.static_counter += 1
-                self.dynamic_counter += 1
+    def execute(self, ctx: Context, message: str):
+        if message and not message.isdigit():
+            return ctx.message.text("Invalid job number", color=Colors.RED).reply_to_user()
+        jobs = self.plugin.executor.abort(int(message) if message else None)
+        if not jobs:
+            return ctx.message.text("No moderation job to abort").reply_to_user()
+        for job in jobs:
+            ctx.message.bold("Cop: ").text(f"aborted {job}").reply_to_channel()
+
+
+class NameIndex:
+    # Casefolded name -> users with that name, plus the names kept sorted for prefix lookups
+    def __init__(self):
+        self.users: Dict[str, Dict[str, ContextUser]] = {}
+        self.names: List[str] = []
+        self.indexed: Dict[str, str] = {}
+
+    def add(self, user: ContextUser):
+        _id = user.id()
+        name = user.name().casefold()
+        old = self.indexed.get(_id)
+        if old is not None and old != name:
+            self._discard(_id, old)
+        self.indexed[_id] = name
+        try:
+            self.users[name][_id] = user
+        except KeyError:
+            self.users[name] = {_id: user}
+            insort(self.names, name)
+
+    def remove(self, user: ContextUser):
+        name = self.indexed.pop(user.id(), None)
+        if name is not None:
+            self._discard(user.id(), name)
+
+    def _discard(self, _id: str, name: str):
+        users = self.users[name]
+        users.pop(_id, None)
+        if not users:
+            del self.users[name]
+            del self.names[bisect_left(self.names, name)]
+
+    def rebuild(self, users: Iterable[ContextUser]):
+        self.users.clear()
+        self.names.clear()
+        self.indexed.clear()
+        for user in users:
+            self.add(user)
+
+    def find(self, name: str) -> List[ContextUser]:
+        return self._verify(list(self.users.get(name.casefold(), {}).values()))
+
+    def prefix(self, prefix: str) -> Dict[str, List[ContextUser]]:
+        prefix = prefix.casefold()
+        matches = {}
+        i = bisect_left(self.names, prefix)
+        while i < len(self.names) and self.names[i].startswith(prefix):
+            matches[self.names[i]] = list(self.users[self.names[i]].values())
+            i += 1
+        for name, users in list(matches.items()):
+            matches[name] = self._verify(users)
+            if not matches[name]:
+                del matches[name]
+        return matches
+
+    def _verify(self, users: List[ContextUser]) -> List[ContextUser]:
+        # There is no rename event: users whose name changed since they were indexed get re-indexed and dropped
+        verified = []
+        for user in users:
+            if user.name().casefold() == self.indexed.get(user.id()):
+                verified.append(user)
             else:
-                self.dynamic_counter += 1
-            if self.dynamic_counter % 2 == 0:
-                self.last_channel = destination
+                self.add(user)
+        return verified
+
+
+REPORT_EVERY = 25
+
+
+class ModerationJob:
+    def __init__(self, _id: int, name: str, actions: List[tuple[Callable, tuple]], ctx: Context | None):
+        self.id = _id
+        self.name = name
+        self.actions = deque(actions)
+        self.total = len(actions)
+        self.done = 0
+        self.failed = 0
+        self.aborted = False
+        self.ctx = ctx
+
+    def __str__(self):
+        failed = f", {self.failed} failed" if self.failed else ""
+        return f"{self.name} #{self.id}: {self.done}/{self.total}{failed}"
+
+    def report(self):
+        if self.ctx:
+            self.ctx.message.bold("Cop: ").text(str(self)).reply_to_channel()
+
+
+class BulkExecutor:
+    # Runs the actions of the moderation jobs in submission order on `concurrency` worker threads, starting at
+    # most `rate` actions per second across all of them
+    def __init__(self, rate: float, concurrency: int):
+        self.rate = rate
+        self.concurrency = concurrency
+        self.jobs: OrderedDict[int, ModerationJob] = OrderedDict()
+        self.counter = count(1)
+        self.next_slot = 0.0
+        self.condition = Condition()
+        self.workers = 0
+
+    def submit(self, name: str, actions: List[tuple[Callable, tuple]], ctx: Context | None = None) -> ModerationJob:
+        with self.condition:
+            job = ModerationJob(next(self.counter), name, actions, ctx)
+            if not job.total:
+                return job
+            self.jobs[job.id] = job
+            while self.workers < self.concurrency:
+                self.workers += 1
+                Thread(target=self.run, name="Cop", daemon=True).start()
+            self.condition.notify_all()
+        if job.ctx and job.total > 1:
+            job.ctx.message.bold("Cop: ").text(f"started {job}").reply_to_channel()
+        return job
+
+    def running(self) -> List[ModerationJob]:
+        with self.condition:
+            return list(self.jobs.values())
+
+    def abort(self, _id: int | None = None) -> List[ModerationJob]:
+        with self.condition:
+            if _id is None:
+                aborted = list(self.jobs.values())
+                self.jobs.clear()
+            else:
+                job = self.jobs.pop(_id, None)
+                aborted = [job] if job else []
+            for job in aborted:
+                job.aborted = True
+                job.actions.clear()
+            return aborted
+
+    def _next(self) -> tuple[ModerationJob, Callable, tuple, float] | None:
+        for job in self.jobs.values():
+            if job.actions:
+                function, args = job.actions.popleft()
+                # Reserve the next start slot so that the workers together respect the rate
+                now = monotonic()
+                self.next_slot = max(now, self.next_slot) + 1 / self.rate
+                return job, function, args, self.next_slot - 1 / self.rate - now
+        return None
+
+    def run(self):
+        while True:
+            with self.condition:
+                while True:
+                    if self.workers > self.concurrency:
+                        self.workers -= 1
+                        return
+                    task = self._next()
+                    if task:
+                        break
+                    self.condition.wait()
+            job, function, args, wait = task
+            if wait > 0:
+                sleep(wait)
+            if job.aborted:
+                continue
+            try:
+                function(*args)
+                failed = False
+            except Exception:
+                traceback.print_exc()
+                failed = True
+            with self.condition:
+                if failed:
+                    job.failed += 1
+                else:
+                    job.done += 1
+                processed = job.done + job.failed
+                finished = processed == job.total
+                if finished:
+                    self.jobs.pop(job.id, None)
+            if job.total > 1 and (finished or processed % REPORT_EVERY == 0):
+                job.report()
+
+
+class RaidDetector:
+    # Join and move counts of the last `size` seconds, one bucket per second in a ring buffer
+    def __init__(self, size: int):
+        self.size = size
+        self.joins = [0] * size
+        self.moves = [0] * size
+        self.total_joins = 0
+        self.total_moves = 0
+        self.second = 0
+
+    def _advance(self, now: float) -> int:
+        second = int(now)
+        elapsed = second - self.second
+        if elapsed >= self.size:
+            self.joins = [0] * self.size
+            self.moves = [0] * self.size
+            self.total_joins = 0
+            self.total_moves = 0
+        else:
+            # Each bucket is cleared at most once per second, whatever the event rate
+            for s in range(self.second + 1, second + 1):
+                i = s % self.size
+                self.total_joins -= self.joins[i]
+                self.total_moves -= self.moves[i]
+                self.joins[i] = 0
+                self.moves[i] = 0
+        if elapsed > 0:
+            self.second = second
+        return self.second % self.size
+
+    def join(self, now: float) -> int:
+        self.joins[self._advance(now)] += 1
+        self.total_joins += 1
+        return self.total_joins
+
+    def move(self, now: float) -> int:
+        self.moves[self._advance(now)] += 1
+        self.total_moves += 1
+        return self.total_moves
+
+
+MAX_RECORDS = 10000
+MAX_RECENT = 1000
+
+
+class MoveMap:
+    # Per user token buckets: every move spends a dynamic token, going back to the channel left on the previous
+    # move also spends a static one. Both refill at one token every move time limit, up to their move limit.
+    __slots__ = ("kick_counter", "static_tokens", "dynamic_tokens", "last_channel", "previous_channel", "last_move")
+
+    def __init__(self, channel_id: str | None, now: float):
+        self.kick_counter: int = 0
+        # Full buckets, capped to the configured limits on the first check
+        self.static_tokens: float = float("inf")
+        self.dynamic_tokens: float = float("inf")
+        self.last_channel: str | None = channel_id
+        self.previous_channel: str | None = None
+        self.last_move: float = now
+
+    def check(self, destination_id: str, move_time_limit: float, static_limit: int, dynamic_limit: int,
+              now: float):
+        refill = (now - self.last_move) / move_time_limit
+        self.last_move = now
+        static_tokens = self.static_tokens + refill
+        dynamic_tokens = self.dynamic_tokens + refill
+        self.static_tokens = static_tokens if static_tokens < static_limit else static_limit
+        self.dynamic_tokens = (dynamic_tokens if dynamic_tokens < dynamic_limit else dynamic_limit) - 1
+        if destination_id == self.previous_channel:
+            self.static_tokens -= 1
+        self.previous_channel = self.last_channel
+        self.last_channel = destination_id
+
+
+class MoveMaps:
+    # Records ordered from the least to the most recently used, idle ones are evicted from the front
+    def __init__(self, ttl: float, capacity: int):
+        self.ttl = ttl
+        self.capacity = capacity
+        self.records: OrderedDict[str, MoveMap] = OrderedDict()
+
+    def __len__(self):
+        return len(self.records)
+
+    def __contains__(self, _id: str):
+        return _id in self.records
+
+    def get(self, user: ContextUser, now: float) -> MoveMap:
+        _id = user.id()
+        record = self.records.get(_id)
+        if record is None:
+            channel = user.current_channel()
+            record = MoveMap(channel.id() if channel else None, now)
+            self.records[_id] = record
         else:
-            self.static_counter = self.static_counter - 1 if self.static_counter > 0 else 0
-            self.dynamic_counter = self.dynamic_counter - 1 if self.dynamic_counter > 0 else 0
-        self.last_move = datetime.now()
+            self.records.move_to_end(_id)
+        self.evict(now)
+        return record
+
+    def evict(self, now: float):
+        records = self.records
+        while records:
+            oldest = next(iter(records.values()))
+            if len(records) <= self.capacity and now - oldest.last_move < self.ttl:
+                return
+            records.popitem(last=False)
 
 
 class CopPlugin(Plugin):
     def __init__(self):
         super().__init__("cop", "Cop", "This is the police!", ["nico9889"])
-        self.add_command(KickCommand())
-        self.add_command(BanCommand())
-        self.add_command(RageCommand())
-        self.move_map: Dict[str, MoveMap] = {}
+        self.add_command(KickCommand(self))
+        self.add_command(BanCommand(self))
+        self.add_command(RageCommand(self))
+        self.add_command(Jobs(self))
+        self.add_command(Abort(self))
+        self.move_map = MoveMaps(60 * 60, MAX_RECORDS)
+        self.names = NameIndex()
+        self.raid = RaidDetector(10)
+        self.executor = BulkExecutor(2, 2)
+        self.recent: deque[tuple[float, ContextUser]] = deque(maxlen=MAX_RECENT)
+        self.lockdown_until = 0.0
         self.set_callback(Callback.OnUserMoved, self.on_user_moved)
         self.set_callback(Callback.OnUserJoinServer, self.on_user_joined)
+        self.set_callback(Callback.OnUserLeaveServer, self.on_user_leaved)
 
     def on_load(self, ctx: Context):
+        self.names.rebuild(ctx.users.values())
         dynamic_counter_option = NumberOption("Dynamic Counter",
                                               "Number of moves that the user is allowed to do between different channels",
                                               self.dynamic_move_limit, 2, 60, 1)
@@ -94,24 +403,58 @@ class CopPlugin(Plugin):
                                              "Number of moves that the user is allowed to do between two channels",
                                              self.static_move_limit, 2, 60, 1)
         move_time_limit_option = NumberOption("Move time limit",
-                                              "Time that has to elapsed between movement in seconds."
-                                              "If the user moves in less time, it's considered spam and increase a"
-                                              " counter, otherwise it decreases the counter if necessary.",
+                                              "Seconds needed to earn back one move. Moves are spent from an "
+                                              "allowance as big as the counters and refilled at this pace.",
                                               self.move_time_limit, 1, 60, 1)
         kick_limit_option = NumberOption("Kick time limit", "If the user get kicked more than n times, "
                                                             "he/she will be permanently ban on the next "
                                                             "infraction. If 0 this is disabled.",
                                          self.kick_limit, 0, 60, 1)
+        idle_time_option = NumberOption("Idle time", "Minutes after which the move history of an idle user is "
+                                                     "forgotten, kicks included.", self.idle_time, 1, 1440, 1)
+        raid_window_option = NumberOption("Raid window", "Seconds over which joins and moves are counted to detect "
+                                                         "a raid", self.raid_window, 1, 300, 1)
+        raid_joins_option = NumberOption("Raid joins", "Joins within the raid window that start a lockdown. "
+                                                       "If 0 this is disabled.", self.raid_joins, 0, 1000, 1)
+        raid_moves_option = NumberOption("Raid moves", "Moves within the raid window that start a lockdown. "
+                                                       "If 0 this is disabled.", self.raid_moves, 0, 10000, 1)
+        lockdown_time_option = NumberOption("Lockdown time", "Seconds of lockdown after a raid. Users who joined "
+                                                             "during the raid window or the lockdown get kicked.",
+                                            self.lockdown_time, 10, 3600, 1)
+        action_rate_option = NumberOption("Action rate", "Maximum number of kicks and bans per second started by "
+                                                         "lockdowns, !rage and bulk !kick/!ban",
+                                          self.action_rate, 1, 50, 1)
+        action_concurrency_option = NumberOption("Action concurrency", "Maximum number of kicks and bans running "
+                                                                       "at the same time", self.action_concurrency,
+                                                 1, 16, 1)
 
         dynamic_counter_option.on_change = lambda value: setattr(self, "dynamic_move_limit", int(value)) or True
         static_counter_option.on_change = lambda value: setattr(self, "static_move_limit", int(value)) or True
         move_time_limit_option.on_change = lambda value: setattr(self, "move_time_limit", int(value) if value > 0 else None) or True
         kick_limit_option.on_change = lambda value: setattr(self, "kick_limit", int(value)) or True
+        idle_time_option.on_change = lambda value: self.set_idle_time(int(value)) or True
+        raid_window_option.on_change = lambda value: self.set_raid_window(int(value)) or True
+        raid_joins_option.on_change = lambda value: setattr(self, "raid_joins", int(value)) or True
+        raid_moves_option.on_change = lambda value: setattr(self, "raid_moves", int(value)) or True
+        lockdown_time_option.on_change = lambda value: setattr(self, "lockdown_time", int(value)) or True
+        action_rate_option.on_change = lambda value: self.set_action_rate(int(value)) or True
+        action_concurrency_option.on_change = lambda value: setattr(self, "action_concurrency", int(value)) or True
 
         self.options.add(move_time_limit_option)
         self.options.add(dynamic_counter_option)
         self.options.add(static_counter_option)
         self.options.add(kick_limit_option)
+        self.options.add(idle_time_option)
+        self.options.add(raid_window_option)
+        self.options.add(raid_joins_option)
+        self.options.add(raid_moves_option)
+        self.options.add(lockdown_time_option)
+        self.options.add(action_rate_option)
+        self.options.add(action_concurrency_option)
+        self.move_map.ttl = self.idle_time * 60
+        self.raid = RaidDetector(self.raid_window)
+        self.executor.rate = self.action_rate
+        self.executor.concurrency = self.action_concurrency
 
     @property
     def move_time_limit(self) -> int:
@@ -145,31 +488,160 @@ class CopPlugin(Plugin):
     def kick_limit(self, kick_limit: int):
         self.instance_storage["kick_limit"] = kick_limit
 
+    @property
+    def idle_time(self) -> int:
+        return self.instance_storage.get("idle_time") or 60
+
+    @idle_time.setter
+    def idle_time(self, minutes: int):
+        self.instance_storage["idle_time"] = minutes
+
+    def set_idle_time(self, minutes: int):
+        self.idle_time = minutes
+        self.move_map.ttl = minutes * 60
+
+    @property
+    def raid_window(self) -> int:
+        return self.instance_storage.get("raid_window") or 10
+
+    @raid_window.setter
+    def raid_window(self, seconds: int):
+        self.instance_storage["raid_window"] = seconds
+
+    def set_raid_window(self, seconds: int):
+        self.raid_window = seconds
+        self.raid = RaidDetector(seconds)
+
+    @property
+    def raid_joins(self) -> int:
+        joins = self.instance_storage.get("raid_joins")
+        return 0 if joins is None else joins
+
+    @raid_joins.setter
+    def raid_joins(self, joins: int):
+        self.instance_storage["raid_joins"] = joins
+
+    @property
+    def raid_moves(self) -> int:
+        moves = self.instance_storage.get("raid_moves")
+        return 0 if moves is None else moves
+
+    @raid_moves.setter
+    def raid_moves(self, moves: int):
+        self.instance_storage["raid_moves"] = moves
+
+    @property
+    def lockdown_time(self) -> int:
+        return self.instance_storage.get("lockdown_time") or 120
+
+    @lockdown_time.setter
+    def lockdown_time(self, seconds: int):
+        self.instance_storage["lockdown_time"] = seconds
+
+    @property
+    def action_rate(self) -> int:
+        return self.instance_storage.get("action_rate") or 2
+
+    @action_rate.setter
+    def action_rate(self, rate: int):
+        self.instance_storage["action_rate"] = rate
+
+    def set_action_rate(self, rate: int):
+        self.action_rate = rate
+        self.executor.rate = rate
+
+    @property
+    def action_concurrency(self) -> int:
+        return self.instance_storage.get("action_concurrency") or 2
+
+    @action_concurrency.setter
+    def action_concurrency(self, concurrency: int):
+        self.instance_storage["action_concurrency"] = concurrency
+        self.executor.concurrency = concurrency
+
+    def lockdown(self, ctx: Context, now: float):
+        self.lockdown_until = now + self.lockdown_time
+        since = now - self.raid_window
+        actions = []
+        while self.recent:
+            joined, user = self.recent.pop()
+            if joined < since:
+                break
+            actions.append((user.kick, ("The server is under attack, try again later",)))
+        self.recent.clear()
+        ctx.message.bold("Cop: ", color=Colors.RED) \
+            .text(f"raid detected! Lockdown for {self.lockdown_time} seconds, kicking {len(actions)} new users") \
+            .reply_to_channel()
+        self.executor.submit("lockdown", actions, ctx)
+
+    def targets(self, ctx: Context, usernames: str) -> List[ContextUser]:
+        users = {}
+        for username in usernames.split(","):
+            if username:
+                for user in self._targets(ctx, username):
+                    users[user.id()] = user
+        return list(users.values())
+
+    def _targets(self, ctx: Context, username: str) -> List[ContextUser]:
+        users = self.names.find(username)
+        if users:
+            return users
+        matches = self.names.prefix(username)
+        if not matches:
+            # Users renamed into this name are not indexed under it yet
+            self.names.rebuild(ctx.users.values())
+            users = self.names.find(username)
+            if users:
+                return users
+            matches = self.names.prefix(username)
+        if len(matches) > 1:
+            li = ctx.message.text(f"{username} matches more than one user:").list()
+            for users in matches.values():
+                for user in users:
+                    li.add(user.name())
+            li.close().reply_to_user()
+            return []
+        for users in matches.values():
+            return users
+        ctx.message.text(f"No user found matching {username}", color=Colors.RED).reply_to_user()
+        return []
+
     def on_user_joined(self, ctx: Context):
-        if ctx.user.id() not in self.move_map:
-            self.move_map[ctx.user.id()] = MoveMap(self, ctx.user)
+        now = monotonic()
+        if now < self.lockdown_until:
+            self.executor.submit("lockdown", [(ctx.user.kick, ("The server is under attack, try again later",))])
+            return
+        self.move_map.get(ctx.user, now)
+        self.names.add(ctx.user)
+        self.recent.append((now, ctx.user))
+        if self.raid.join(now) > self.raid_joins > 0:
+            self.lockdown(ctx, now)
+
+    def on_user_leaved(self, ctx: Context):
+        self.names.remove(ctx.user)
 
     def on_user_moved(self, ctx: Context, channel: ContextChannel, actor: ContextUser):
-        if ctx.user == actor and ctx.user != ctx.me:
-            try:
-                last_move = self.move_map[actor.id()]
-            except KeyError:
-                last_move = MoveMap(self, ctx.user)
-                self.move_map[actor.id()] = last_move
-            last_move.check(channel)
+        if ctx.user == ctx.me:
+            return
+        now = monotonic()
+        if self.raid.move(now) > self.raid_moves > 0 and now >= self.lockdown_until:
+            self.lockdown(ctx, now)
+        if ctx.user == actor:
+            last_move = self.move_map.get(actor, now)
+            last_move.check(channel.id(), self.move_time_limit, self.static_move_limit, self.dynamic_move_limit, now)
             if self.kick_limit and last_move.kick_counter > self.kick_limit:
-                if last_move.static_counter > self.static_move_limit and last_move.dynamic_counter > self.dynamic_move_limit:
+                if last_move.static_tokens < 0 and last_move.dynamic_tokens < 0:
                     ctx.user.ban("I'm tired of kicking you, let's make this permanent. Goodbye")
             else:
-                if last_move.static_counter > self.static_move_limit:
+                if last_move.static_tokens < 0:
                     ctx.user.kick("Where are you going back and forth so fast?")
-                    last_move.dynamic_counter -= 1
+                    last_move.static_tokens += 1
                     last_move.kick_counter += 1
-                elif last_move.dynamic_counter > self.dynamic_move_limit:
+                elif last_move.dynamic_tokens < 0:
                     ctx.user.kick("Please calm down! You are moving everywhere so fast!")
-                    last_move.dynamic_counter -= 1
+                    last_move.dynamic_tokens += 1
                     last_move.kick_counter += 1
-                elif last_move.static_counter == self.static_move_limit or last_move.dynamic_counter == self.dynamic_move_limit:
+                elif last_move.static_tokens < 1 or last_move.dynamic_tokens < 1:
                     ctx.message.text("Warning: you are moving too fast. On the next move you will be kicked!",
                                      color=Colors.ORANGE).send_to_user(ctx.user)
 
@@ -0,0 +1,199 @@
+from __future__ import annotations
+
+import argparse
+import random
+import sys
+import time
+import tracemalloc
+from collections import Counter
+from typing import Dict, List
+
+from . import CopPlugin
+
+NORMAL = "normal"
+HOPPER = "hopper"
+RAIDER = "raider"
+
+
+class Clock:
+    # Simulated time, the plugin reads it in place of time.monotonic
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self) -> float:
+        return self.now
+
+
+class StubMessage:
+    def __getattr__(self, _):
+        return lambda *args, **kwargs: self
+
+
+class StubChannel:
+    def __init__(self, _id: str):
+        self._id = _id
+
+    def id(self) -> str:
+        return self._id
+
+    def name(self) -> str:
+        return self._id
+
+
+class StubUser:
+    def __init__(self, _id: str, kind: str, channel: StubChannel | None, decisions: Counter):
+        self._id = _id
+        self.kind = kind
+        self.channel = channel
+        self.decisions = decisions
+        self.gone = False
+
+    def id(self) -> str:
+        return self._id
+
+    def name(self) -> str:
+        return f"{self.kind}{self._id}"
+
+    def current_channel(self) -> StubChannel | None:
+        return self.channel
+
+    def kick(self, reason: str):
+        self.decisions[(self.kind, "kick")] += 1
+        self.gone = True
+
+    def ban(self, reason: str):
+        self.decisions[(self.kind, "ban")] += 1
+        self.gone = True
+
+
+class StubContext:
+    def __init__(self, users: Dict[str, StubUser], me: StubUser):
+        self.users = users
+        self.me = me
+        self.user: StubUser | None = None
+        self.message = StubMessage()
+
+
+def generate(args: argparse.Namespace, channels: List[StubChannel], decisions: Counter):
+    rng = random.Random(args.seed)
+    users: Dict[str, StubUser] = {}
+    events = []
+
+    def user(kind: str, channel: StubChannel | None) -> StubUser:
+        u = StubUser(str(len(users)), kind, channel, decisions)
+        users[u.id()] = u
+        return u
+
+    for _ in range(args.users):
+        u = user(NORMAL, rng.choice(channels))
+        t = rng.expovariate(1 / args.normal_interval)
+        while t < args.duration:
+            events.append((t, "move", u, rng.choice(channels)))
+            t += rng.expovariate(1 / args.normal_interval)
+    for _ in range(args.hoppers):
+        u = user(HOPPER, channels[0])
+        t = rng.uniform(0, args.duration)
+        for i in range(rng.randint(5, 20)):
+            t += rng.uniform(0.3, 1.5)
+            events.append((t, "move", u, channels[i % 2 + 1]))
+    if args.raiders:
+        start = rng.uniform(0, args.duration / 2)
+        for _ in range(args.raiders):
+            u = user(RAIDER, None)
+            t = start + rng.uniform(0, args.raid_time)
+            events.append((t, "join", u, channels[0]))
+            for _ in range(rng.randint(0, 3)):
+                t += rng.uniform(0.2, 2)
+                events.append((t, "move", u, rng.choice(channels)))
+    events.sort(key=lambda event: event[0])
+    return users, events
+
+
+def percentile(values: List[int], p: float) -> float:
+    return values[min(len(values) - 1, int(len(values) * p))] / 1000 if values else 0.0
+
+
+def run(args: argparse.Namespace):
+    decisions = Counter()
+    channels = [StubChannel(f"channel{i}") for i in range(args.channels)]
+    users, events = generate(args, channels, decisions)
+    me = StubUser("me", "bot", channels[0], decisions)
+    present = {_id: u for _id, u in users.items() if u.kind != RAIDER}
+    ctx = StubContext(present, me)
+
+    clock = Clock()
+    sys.modules[__package__].monotonic = clock
+    plugin = CopPlugin()
+    plugin.on_load(ctx)
+    plugin.raid_joins = args.raid_joins
+    plugin.executor.rate = 1e9
+    lockdowns = []
+    lockdown = plugin.lockdown
+    plugin.lockdown = lambda c, now: lockdowns.append(now) or lockdown(c, now)
+
+    if args.memory:
+        tracemalloc.start()
+    memory_start = tracemalloc.get_traced_memory()[0] if args.memory else 0
+    latencies = {"move": [], "join": []}
+    samples = []
+    sample_every = max(1, len(events) // 10)
+    perf_counter_ns = time.perf_counter_ns
+    started = time.perf_counter()
+    for n, (t, kind, user, channel) in enumerate(events):
+        if user.gone:
+            continue
+        clock.now = t
+        ctx.user = user
+        begin = perf_counter_ns()
+        if kind == "join":
+            user.channel = channel
+            present[user.id()] = user
+            plugin.on_user_joined(ctx)
+        else:
+            user.channel = channel
+            plugin.on_user_moved(ctx, channel, user)
+        latencies[kind].append(perf_counter_ns() - begin)
+        if n % sample_every == 0:
+            samples.append((t, len(plugin.move_map)))
+    elapsed = time.perf_counter() - started
+    while plugin.executor.running():
+        time.sleep(0.01)
+    memory_end = tracemalloc.get_traced_memory()[0] if args.memory else 0
+
+    processed = sum(len(values) for values in latencies.values())
+    print(f"Events: {processed} in {elapsed:.3f}s ({processed / elapsed if elapsed else 0:.0f} events/s)")
+    for kind, values in latencies.items():
+        values.sort()
+        if values:
+            print(f"{kind:>5} latency (us): p50 {percentile(values, 0.5):.1f}  p95 {percentile(values, 0.95):.1f}  "
+                  f"p99 {percentile(values, 0.99):.1f}  max {values[-1] / 1000:.1f}")
+    print("move_map size over simulated time: " + ", ".join(f"{t:.0f}s={size}" for t, size in samples))
+    if args.memory:
+        print(f"Traced memory growth: {(memory_end - memory_start) / 1024:.1f} KiB")
+    print(f"Lockdowns: {len(lockdowns)}" + (f" (first at {lockdowns[0]:.0f}s)" if lockdowns else ""))
+    population = Counter(u.kind for u in users.values())
+    print("Decisions:")
+    for kind in (NORMAL, HOPPER, RAIDER):
+        print(f"  {kind:>6}: {population[kind]} users, {decisions[(kind, 'kick')]} kicked, "
+              f"{decisions[(kind, 'ban')]} banned")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay a synthetic stream of joins and moves through CopPlugin "
+                                                 "and report throughput, latency, memory and decisions")
+    parser.add_argument("--users", type=int, default=2000, help="normal users")
+    parser.add_argument("--hoppers", type=int, default=20, help="users hopping between two channels")
+    parser.add_argument("--raiders", type=int, default=200, help="users joining in a raid")
+    parser.add_argument("--channels", type=int, default=20)
+    parser.add_argument("--duration", type=float, default=3600, help="simulated seconds")
+    parser.add_argument("--normal-interval", type=float, default=120, help="mean seconds between normal moves")
+    parser.add_argument("--raid-time", type=float, default=5, help="seconds over which the raiders join")
+    parser.add_argument("--raid-joins", type=int, default=10, help="joins in the raid window that start a lockdown, "
+                                                                   "0 disables it as in the plugin default")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--memory", action="store_true", help="trace memory allocations (slower)")
+    run(parser.parse_args())
+
+
+if __name__ == "__main__":
+    main()
@@ -7,7 +7,10 @@ if TYPE_CHECKING:
     from mello.utils.plugins.channels import ContextChannel
     from mello.utils.plugins.user import ContextUser
 
+from threading import RLock, Timer
+
 from mello.utils.plugins import DecoratorPlugin
+from mello.utils.plugins.message import Colors
 
 plugin = DecoratorPlugin("home", "Home", "Set a channel where the bot returns if left alone", ["nico9889"])
 
@@ -20,23 +23,91 @@ def home(ctx: DecoratorContext):
         pass
 
 
+def delay(ctx: DecoratorContext) -> float:
+    value = ctx.instance_storage.get("delay")
+    return 5 if value is None else value
+
+
+def present(ctx: DecoratorContext) -> set[str]:
+    # Users in the bot channel, counted again only when the bot moves
+    state = ctx.state
+    if state["channel"] is None:
+        channel = ctx.me.current_channel()
+        if not channel:
+            return set()
+        state["channel"] = channel.id()
+        state["present"] = {user.id() for user in channel.users()}
+    return state["present"]
+
+
+def cancel(ctx: DecoratorContext):
+    timer = ctx.state["timer"]
+    if timer:
+        timer.cancel()
+        ctx.state["timer"] = None
+
+
+def schedule(ctx: DecoratorContext):
+    state = ctx.state
+    if state["timer"] or not ctx.instance_storage.get("enabled") or \
+            state["channel"] == ctx.instance_storage.get("channel"):
+        return
+    timer = Timer(delay(ctx), home_later, [ctx])
+    timer.daemon = True
+    state["timer"] = timer
+    timer.start()
+
+
+def home_later(ctx: DecoratorContext):
+    with ctx.state["lock"]:
+        ctx.state["timer"] = None
+        if not ctx.instance_storage.get("enabled"):
+            return
+        # The cache is only a hint, count once more before leaving
+        ctx.state["channel"] = None
+        if present(ctx):
+            return
+        home(ctx)
+
+
 @plugin.state
 def create_state():
     return {
-        "last_channel": None
+        "last_channel": None,
+        "channel": None,
+        "present": set(),
+        "timer": None,
+        "lock": RLock()
     }
 
 
 @plugin.on_user_leaved
 def _on_user_leaved(ctx: DecoratorContext):
-    channel = ctx.me.current_channel()
-    if channel and ctx.instance_storage.get("enabled") and not channel.users():
-        home(ctx)
+    with ctx.state["lock"]:
+        users = present(ctx)
+        users.discard(ctx.user.id())
+        if not users:
+            schedule(ctx)
 
 
 @plugin.on_user_moved
 def _on_user_moved(ctx: DecoratorContext, channel: ContextChannel, actor: ContextUser):
-    _on_user_leaved(ctx)
+    with ctx.state["lock"]:
+        if ctx.user == ctx.me:
+            cancel(ctx)
+            ctx.state["channel"] = None
+            if not present(ctx):
+                schedule(ctx)
+        else:
+            users = present(ctx)
+            if channel.id() == ctx.state["channel"]:
+                users.add(ctx.user.id())
+                # Somebody came back in time
+                cancel(ctx)
+            else:
+                users.discard(ctx.user.id())
+                if not users:
+                    schedule(ctx)
     if ctx.user == ctx.me and actor != ctx.me:
         if actor.current_channel() == channel:
             ctx.state["last_channel"] = channel
@@ -74,6 +145,9 @@ def _home(ctx: DecoratorContext, message: str):
     else:
         enabled = not ctx.instance_storage["enabled"]
     ctx.instance_storage["enabled"] = enabled
+    if not enabled:
+        with ctx.state["lock"]:
+            cancel(ctx)
     if enabled:
         m = ctx.message.bold("Enabled")
     else:
@@ -85,3 +159,21 @@ def _home(ctx: DecoratorContext, message: str):
 def _come(ctx: DecoratorContext, _: str):
     ctx.user.current_channel().join()
     ctx.message.text("Here I am (´• ω •`)").reply_to_channel()
+
+
+@plugin.command("homedelay", "Seconds the bot waits alone before going home")
+def _home_delay(ctx: DecoratorContext, message: str):
+    if not message:
+        ctx.message.bold("Current delay: ").text(f"{delay(ctx):g} seconds").reply_to_user()
+        return
+    try:
+        value = float(message)
+        if value >= 0:
+            ctx.instance_storage["delay"] = value
+            ctx.message.text("The bot will go home after ").bold(f"{value:g} seconds").text(" alone") \
+                .reply_to_channel()
+            return
+    except ValueError:
+        pass
+    ctx.message.text("Invalid delay. Please give a value in seconds >= 0", bold=True,
+                     color=Colors.RED).reply_to_user()
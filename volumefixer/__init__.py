@@ -4,12 +4,185 @@ from typing import TYPE_CHECKING
 
 if TYPE_CHECKING:
     from mello.utils.plugins.context import Context
-    from typing import Dict
+    from typing import Dict, List
+
+import hashlib
+import os
+import shutil
+import subprocess
+import traceback
+from concurrent.futures import Future, ProcessPoolExecutor
+from heapq import heappop, heappush
+from itertools import count
+from threading import Condition, Lock, Thread
+from time import monotonic
 
 from mello.utils.plugins import Plugin, Command
 from mello.utils.plugins.callbacks import Callback
 from mello.utils.plugins.media import ContextTrack
 from mello.utils.plugins.message import Colors
+from mello.utils.plugins.web.options.number_option import NumberOption
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+SAMPLE_RATE = 48000
+BLOCK = SAMPLE_RATE // 10  # 100 ms, a quarter of a BS.1770 gating block
+SEGMENT = BLOCK * 600  # Audio is decoded and K-weighted one minute at a time to bound the worker memory
+FRAME = 2 * 4  # Two float32 channels
+PREROLL = BLOCK  # Discarded at the start of every segment, covers the filters' settling time
+
+RAMP_STEPS = 8
+
+# ITU-R BS.1770 K-weighting at 48 kHz: high shelf followed by the RLB high pass, as (b, a) biquads
+K_WEIGHTING = (
+    ((1.53512485958697, -2.69169618940638, 1.19839281085285), (1.0, -1.69065929318241, 0.73248077421585)),
+    ((1.0, -2.0, 1.0), (1.0, -1.99004745483398, 0.99007225036621)),
+)
+
+
+def track_path(track: ContextTrack) -> str | None:
+    return getattr(track, "path", None)
+
+
+def fingerprint(path: str) -> str:
+    digest = hashlib.blake2b(digest_size=16)
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def decode(stream):
+    # Reads ffmpeg's output SEGMENT frames at a time, never the whole track
+    while True:
+        data = stream.read(SEGMENT * FRAME)
+        usable = len(data) // FRAME * FRAME
+        if not usable:
+            return
+        yield np.frombuffer(data[:usable], dtype=np.float32).reshape(-1, 2)
+
+
+def k_weight(samples):
+    # The biquads are applied in the frequency domain, evaluating their response on the FFT bins
+    z = np.exp(-2j * np.pi * np.fft.rfftfreq(samples.shape[0]))
+    response = np.ones_like(z)
+    for b, a in K_WEIGHTING:
+        response *= (b[0] + b[1] * z + b[2] * z * z) / (a[0] + a[1] * z + a[2] * z * z)
+    return np.fft.irfft(np.fft.rfft(samples, axis=0) * response[:, None], samples.shape[0], axis=0)
+
+
+def integrated_loudness(segments) -> float | None:
+    powers = []
+    tail = None
+    for segment in segments:
+        preroll = 0 if tail is None else tail.shape[0]
+        filtered = k_weight(segment if tail is None else np.concatenate((tail, segment)))[preroll:]
+        tail = segment[-PREROLL:]
+        usable = filtered.shape[0] // BLOCK * BLOCK
+        # Mean square of every 100 ms sub-block, summed over the channels
+        powers.append(np.square(filtered[:usable]).reshape(-1, BLOCK, filtered.shape[1]).mean(axis=1).sum(axis=1))
+    if not powers:
+        return None
+    power = np.concatenate(powers)
+    if power.shape[0] < 4:
+        return None
+    # 400 ms blocks with 75% overlap, then the absolute (-70 LUFS) and relative (-10 LU) gates
+    blocks = np.convolve(power, np.full(4, 0.25), mode="valid")
+    blocks = blocks[blocks > 10 ** ((-70 + 0.691) / 10)]
+    if not blocks.shape[0]:
+        return None
+    threshold = np.mean(blocks) * 10 ** (-10 / 10)
+    gated = blocks[blocks > threshold]
+    return float(-0.691 + 10 * np.log10(np.mean(gated)))
+
+
+def analyze(path: str) -> float | None:
+    process = subprocess.Popen(["ffmpeg", "-v", "error", "-i", path, "-f", "f32le", "-ac", "2",
+                                "-ar", str(SAMPLE_RATE), "-"], stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+    try:
+        loudness = integrated_loudness(decode(process.stdout))
+    finally:
+        process.stdout.close()
+        returncode = process.wait()
+    if returncode != 0:
+        raise RuntimeError(f"ffmpeg exited with status {returncode}")
+    return loudness
+
+
+class RampScheduler:
+    # One thread per process steps the volume ramps of every player
+    def __init__(self):
+        self.queue: list[tuple[float, int, VolumeRamp, int]] = []
+        self.counter = count()
+        self.condition = Condition()
+        self.thread: Thread | None = None
+
+    def schedule(self, due: float, ramp: VolumeRamp, generation: int):
+        with self.condition:
+            heappush(self.queue, (due, next(self.counter), ramp, generation))
+            if self.thread is None:
+                self.thread = Thread(target=self.run, name="VolumeFixerRamps", daemon=True)
+                self.thread.start()
+            self.condition.notify()
+
+    def run(self):
+        while True:
+            with self.condition:
+                while not self.queue or self.queue[0][0] > monotonic():
+                    self.condition.wait(self.queue[0][0] - monotonic() if self.queue else None)
+                _, _, ramp, generation = heappop(self.queue)
+            # A player that fails must not stop the ramps of the others
+            try:
+                ramp.step(generation)
+            except Exception:
+                traceback.print_exc()
+
+
+scheduler = RampScheduler()
+
+
+class VolumeRamp:
+    def __init__(self):
+        self.lock = Lock()
+        self.generation = 0
+        self.media = None
+        self.origin = 0.0
+        self.target = 0.0
+        self.index = 0
+        self.interval = 0.0
+
+    def start(self, media, target: float, duration: float):
+        with self.lock:
+            # Bumping the generation turns the steps still queued for a previous ramp into no-ops
+            self.generation += 1
+            if duration <= 0 or media.volume == target:
+                media.volume = target
+                return
+            self.media = media
+            self.origin = media.volume
+            self.target = target
+            self.index = 0
+            self.interval = duration / RAMP_STEPS
+            generation = self.generation
+        scheduler.schedule(monotonic() + self.interval, self, generation)
+
+    def cancel(self):
+        # The volume has been set outside the ramp, its remaining steps must not override it
+        with self.lock:
+            self.generation += 1
+
+    def step(self, generation: int):
+        with self.lock:
+            if generation != self.generation:
+                return
+            self.index += 1
+            self.media.volume = self.origin + (self.target - self.origin) * self.index / RAMP_STEPS
+            if self.index >= RAMP_STEPS:
+                return
+        scheduler.schedule(monotonic() + self.interval, self, generation)
 
 
 class VolumeFixer(Plugin):
@@ -19,16 +192,91 @@ class VolumeFixer(Plugin):
         self.add_command(VolumeFix(self))
         self.add_command(VFix(self))
         self.add_command(Volume(self))
+        self.add_command(VFAuto(self))
+        self.add_command(VFAnalyze(self))
         self.base_volume = 50
+        self.executor: ProcessPoolExecutor | None = None
+        self.pending: set[str] = set()
+        self.lock = Lock()
+        self.ramp = VolumeRamp()
 
         self.callbacks.set_callback(Callback.OnMusicStart, self.on_music_start)
+        self.callbacks.set_callback(Callback.OnTrackAdd, self.on_track_add)
 
     def on_load(self, ctx: Context):
         if "on" not in self.instance_storage:
             self.instance_storage["on"] = False
         if "volumes" not in self.instance_storage:
             self.instance_storage["volumes"] = {}
+        if "gains" not in self.instance_storage:
+            self.instance_storage["gains"] = {}
+        if "hashes" not in self.instance_storage:
+            self.instance_storage["hashes"] = {}
         self.base_volume = ctx.media.volume
+        target_option = NumberOption("Target loudness",
+                                     "Loudness in LUFS that the analysed tracks are levelled to. Louder tracks "
+                                     "get a lower percentage of the base volume.", self.target, -40, -5, 1)
+        workers_option = NumberOption("Analysis workers", "Maximum number of processes used to analyse tracks",
+                                      self.workers, 1, 16, 1)
+        ramp_option = NumberOption("Ramp duration", "Milliseconds taken to reach the new volume. If 0 the volume "
+                                                    "changes at once.", self.ramp_duration, 0, 5000, 100)
+        target_option.on_change = lambda value: setattr(self, "target", int(value)) or True
+        workers_option.on_change = lambda value: self.set_workers(int(value))
+        ramp_option.on_change = lambda value: setattr(self, "ramp_duration", int(value)) or True
+        self.options.add(target_option)
+        self.options.add(workers_option)
+        self.options.add(ramp_option)
+
+    @property
+    def auto(self) -> bool:
+        return self.instance_storage.get("auto") or False
+
+    @auto.setter
+    def auto(self, auto: bool):
+        self.instance_storage["auto"] = auto
+
+    @property
+    def target(self) -> int:
+        return self.instance_storage.get("target") or -18
+
+    @target.setter
+    def target(self, target: int):
+        self.instance_storage["target"] = target
+
+    @property
+    def workers(self) -> int:
+        return self.instance_storage.get("workers") or min(2, os.cpu_count() or 1)
+
+    @workers.setter
+    def workers(self, workers: int):
+        self.instance_storage["workers"] = workers
+
+    def set_workers(self, workers: int) -> bool:
+        self.workers = workers
+        with self.lock:
+            executor, self.executor = self.executor, None
+        # The work already submitted finishes on the old pool, the next one gets the new size
+        if executor:
+            executor.shutdown(wait=False)
+        return True
+
+    def pool(self) -> ProcessPoolExecutor:
+        with self.lock:
+            if self.executor is None:
+                self.executor = ProcessPoolExecutor(max_workers=self.workers)
+            return self.executor
+
+    @property
+    def ramp_duration(self) -> int:
+        duration = self.instance_storage.get("ramp_duration")
+        return 1000 if duration is None else duration
+
+    @ramp_duration.setter
+    def ramp_duration(self, duration: int):
+        self.instance_storage["ramp_duration"] = duration
+
+    def set_volume(self, ctx: Context, volume: float):
+        self.ramp.start(ctx.media, volume, self.ramp_duration / 1000)
 
     @property
     def on(self) -> bool:
@@ -46,30 +294,160 @@ class VolumeFixer(Plugin):
     def volumes(self, volumes: Dict[str, int]):
         self.instance_storage["volumes"] = volumes
 
+    @property
+    def gains(self) -> Dict[str, int]:
+        return self.instance_storage["gains"]
+
+    @gains.setter
+    def gains(self, gains: Dict[str, int]):
+        self.instance_storage["gains"] = gains
+
+    @property
+    def hashes(self) -> Dict[str, str]:
+        return self.instance_storage["hashes"]
+
+    @hashes.setter
+    def hashes(self, hashes: Dict[str, str]):
+        self.instance_storage["hashes"] = hashes
+
+    def gain(self, track: ContextTrack) -> int:
+        # Gains are keyed by the audio content hash, the per track volumes are kept for files that can't be read
+        _id = str(track.id)
+        try:
+            return self.gains[self.hashes[_id]]
+        except KeyError:
+            return self.volumes[_id]
+
+    def set_gain(self, track: ContextTrack, percentage: int):
+        _id = str(track.id)
+        digest = self.hashes.get(_id)
+        path = track_path(track)
+        if digest is None and path:
+            try:
+                digest = fingerprint(path)
+            except OSError:
+                pass
+        with self.lock:
+            if digest is None:
+                volumes = self.volumes
+                volumes[_id] = percentage
+                self.volumes = volumes
+                return
+            self._index(_id, digest)
+            gains = self.gains
+            gains[digest] = percentage
+            self.gains = gains
+
+    def _index(self, _id: str, digest: str):
+        hashes = self.hashes
+        hashes[_id] = digest
+        self.hashes = hashes
+
     def on_music_start(self, ctx: Context, track: ContextTrack):
         if self.on:
             try:
-                percentage = self.volumes[str(track.id)]
-                ctx.media.volume = self.base_volume / 100 * percentage
+                percentage = self.gain(track)
+                volume = self.base_volume / 100 * percentage
+                self.set_volume(ctx, volume)
                 ctx.message \
                     .bold(f"VolumeFixer:", color=Colors.GREEN) \
-                    .text(f"Volume adjusted to {ctx.media.volume}% ({percentage}% of base volume)") \
+                    .text(f"Volume adjusted to {volume}% ({percentage}% of base volume)") \
                     .reply_to_channel()
             except KeyError:
-                ctx.media.volume = self.base_volume
+                self.set_volume(ctx, self.base_volume)
+
+    def on_track_add(self, ctx: Context, track: ContextTrack):
+        # Always hashed, so a copy of audio already fixed by hand gets its gain; measured only in auto mode
+        self.analyze(ctx, [track], loudness=self.auto and np is not None)
+
+    def analyze(self, ctx: Context, tracks: List[ContextTrack], force: bool = False, loudness: bool = True) -> int:
+        if loudness and shutil.which("ffmpeg") is None:
+            # Reported once here instead of once per track
+            ctx.message.text("VolumeFix: loudness analysis requires ffmpeg to be installed.",
+                             color=Colors.RED).reply_to_channel()
+            loudness = False
+        submitted = 0
+        for track in tracks:
+            _id = str(track.id)
+            path = track_path(track)
+            with self.lock:
+                if not path or _id in self.pending:
+                    continue
+                digest = self.hashes.get(_id)
+                if not force and (_id in self.volumes or digest in self.gains):
+                    continue
+                if digest is not None and not loudness:
+                    continue
+                self.pending.add(_id)
+            if digest is None:
+                future = self.pool().submit(fingerprint, path)
+                future.add_done_callback(
+                    lambda f, _id=_id, path=path: self._hashed(ctx, _id, path, force, loudness, f))
+            else:
+                self._analyze(ctx, _id, path, digest)
+            submitted += 1
+        return submitted
+
+    def _analyze(self, ctx: Context, _id: str, path: str, digest: str):
+        future = self.pool().submit(analyze, path)
+        future.add_done_callback(lambda f: self._analyzed(ctx, _id, digest, f))
+
+    def _hashed(self, ctx: Context, _id: str, path: str, force: bool, loudness: bool, future: Future):
+        try:
+            digest = future.result()
+        except Exception as e:
+            with self.lock:
+                self.pending.discard(_id)
+            ctx.message.text(f"VolumeFix: can't read track {_id}: {e}", color=Colors.RED).reply_to_channel()
+            return
+        with self.lock:
+            self._index(_id, digest)
+            # Same audio seen before under another track ID: reuse its gain without analysing it again
+            cached = not force and digest in self.gains
+            if cached or not loudness:
+                self.pending.discard(_id)
+        if cached:
+            self._refix(ctx, _id)
+        elif loudness:
+            self._analyze(ctx, _id, path, digest)
+
+    def _analyzed(self, ctx: Context, _id: str, digest: str, future: Future):
+        try:
+            loudness = future.result()
+            error = "too short or silent"
+        except Exception as e:
+            loudness = None
+            error = str(e)
+        with self.lock:
+            self.pending.discard(_id)
+        if loudness is None:
+            ctx.message.text(f"VolumeFix: can't measure the loudness of track {_id}: {error}",
+                             color=Colors.RED).reply_to_channel()
+            return
+        with self.lock:
+            gains = self.gains
+            gains[digest] = round(min(100.0, 100 * 10 ** ((self.target - loudness) / 20)))
+            self.gains = gains
+        self._refix(ctx, _id)
+
+    def _refix(self, ctx: Context, _id: str):
+        track = ctx.media.current()
+        if track and str(track.id) == _id:
+            self.fix(ctx)
 
     def fix(self, ctx: Context):
         if self.on:
             track = ctx.media.current()
             if track:
                 try:
-                    percentage = self.volumes[str(track.id)]
-                    ctx.media.volume = self.base_volume / 100 * percentage
+                    percentage = self.gain(track)
+                    volume = self.base_volume / 100 * percentage
+                    self.set_volume(ctx, volume)
                     ctx.message \
-                        .text(f"Volume adjusted to {ctx.media.volume}% ({percentage}% of base volume)") \
+                        .text(f"Volume adjusted to {volume}% ({percentage}% of base volume)") \
                         .reply_to_channel()
                 except KeyError:
-                    pass
+                    self.ramp.cancel()
 
 
 class VFSwitch(Command):
@@ -85,7 +463,7 @@ class VFSwitch(Command):
             self.plugin.base_volume = ctx.media.volume
             message = message.text("enabled")
         else:
-            ctx.media.volume = self.plugin.base_volume
+            self.plugin.set_volume(ctx, self.plugin.base_volume)
             message = message.text("disabled")
         message.reply_to_channel()
 
@@ -107,9 +485,7 @@ class VolumeFix(Command):
         track = ctx.media.current()
         if not track:
             return ctx.message.text("No track is playing right now.", color=Colors.RED).reply_to_channel()
-        volumes = self.plugin.volumes
-        volumes[str(track.id)] = percentage
-        self.plugin.volumes = volumes
+        self.plugin.set_gain(track, percentage)
         self.plugin.fix(ctx)
 
 
@@ -132,7 +508,37 @@ class Volume(Command):
         if not 0 <= volume <= 100:
             return  # Error already reported by media plugin
         self.plugin.base_volume = volume
+        # The media plugin has already applied it
+        self.plugin.ramp.cancel()
         self.plugin.fix(ctx)
 
 
+class VFAuto(Command):
+    def __init__(self, volumefixer: VolumeFixer):
+        super().__init__("vfauto", "Enable/disable the loudness analysis of new tracks")
+        self.plugin = volumefixer
+
+    def execute(self, ctx: Context, message: str):
+        if np is None:
+            return ctx.message.text("Loudness analysis requires NumPy to be installed.",
+                                    color=Colors.RED).reply_to_channel()
+        self.plugin.auto = not self.plugin.auto
+        ctx.message.bold("VolumeFix: ").text(f"automatic analysis {'enabled' if self.plugin.auto else 'disabled'}") \
+            .reply_to_channel()
+
+
+class VFAnalyze(Command):
+    def __init__(self, volumefixer: VolumeFixer):
+        super().__init__("vfanalyze", "Analyse the loudness of every track without a volume fix. "
+                                      "Use !vfanalyze all to analyse again every track.")
+        self.plugin = volumefixer
+
+    def execute(self, ctx: Context, message: str):
+        if np is None:
+            return ctx.message.text("Loudness analysis requires NumPy to be installed.",
+                                    color=Colors.RED).reply_to_channel()
+        submitted = self.plugin.analyze(ctx, ctx.media.tracks(), force=message == "all")
+        ctx.message.bold("VolumeFix: ").text(f"analysing {submitted} tracks in background").reply_to_channel()
+
+
 plugin = VolumeFixer
@@ -8,25 +8,267 @@ if TYPE_CHECKING:
     from mello.utils.plugins.context import Context
     from mello.utils.plugins.channels import ContextChannel
     from mello.utils.plugins.user import ContextUser
-    from typing import Dict
+    from typing import Callable, Dict, Hashable
+
+import traceback
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from threading import Lock, Timer
+from time import monotonic
 
 from mello.utils.plugins import Plugin, Command
 from mello.utils.plugins.callbacks import Callback
+from mello.utils.plugins.web.options.number_option import NumberOption
 from mello.utils.plugins.web.options.string_option import StringOption
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 HEADERS = {
     "Accept": "application/json",
     "Content-Type": "application/json"
 }
+API_URL = "https://api.w2g.tv"
+# Seconds to connect and to wait for the response
+TIMEOUT = (5, 15)
+POOL_SIZE = 4
+
+
+class W2GClient:
+    # One keep-alive session for all the calls, retried with backoff when W2G is busy or unreachable
+    def __init__(self, api_url: str = API_URL):
+        self.api_url = api_url
+        self.session = requests.Session()
+        self.session.headers.update(HEADERS)
+        # Retried only when W2G can't have applied the request: failed connections, and 429/503 answers that
+        # reject it. Read errors and any other answer are never retried, a second POST could duplicate a room
+        # or playlist items
+        retry = Retry(total=3, connect=3, read=0, other=0, status=3, backoff_factor=0.5,
+                      status_forcelist=(429, 503), allowed_methods=None, raise_on_status=False)
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=POOL_SIZE, max_retries=retry)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+    def post(self, path: str, payload: dict) -> requests.Response | None:
+        try:
+            return self.session.post(f"{self.api_url.rstrip('/')}/{path}", json=payload, timeout=TIMEOUT)
+        except requests.RequestException:
+            return None
+
+    def create(self, token: str, share: str, color: str) -> requests.Response | None:
+        return self.post("rooms/create.json", {
+            "w2g_api_key": token,
+            "share": share,
+            "bg_color": color,
+            "bg_opacity": "100"
+        })
+
+    def update(self, room: str, token: str, url: str) -> requests.Response | None:
+        return self.post(f"rooms/{room}/sync_update", {
+            "w2g_api_key": token,
+            "item_url": url
+        })
+
+    def add_items(self, room: str, token: str, videos: list[dict]) -> requests.Response | None:
+        return self.post(f"rooms/{room}/playlists/current/playlist_items/sync_update", {
+            "w2g_api_key": token,
+            "add_items": videos
+        })
+
+    def close(self):
+        self.session.close()
+
+
+class RoomExecutor:
+    # Runs the API calls off the event thread: calls for the same room in submission order, different rooms in
+    # parallel. `done` gets the result of the call on the worker thread and posts the reply
+    def __init__(self, workers: int = POOL_SIZE):
+        self.pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="W2G")
+        self.queues: Dict[Hashable, deque[tuple[Callable, Callable]]] = {}
+        self.lock = Lock()
+
+    def submit(self, key: Hashable, call: Callable, done: Callable):
+        with self.lock:
+            queue = self.queues.get(key)
+            if queue is not None:
+                # Picked up by the worker already draining this room
+                queue.append((call, done))
+                return
+            self.queues[key] = deque([(call, done)])
+        self.pool.submit(self.drain, key)
+
+    def drain(self, key: Hashable):
+        while True:
+            with self.lock:
+                queue = self.queues[key]
+                if not queue:
+                    del self.queues[key]
+                    return
+                call, done = queue.popleft()
+            try:
+                done(call())
+            except Exception:
+                traceback.print_exc()
+
+
+class Batch:
+    __slots__ = ("urls", "added", "url", "updated")
+
+    def __init__(self):
+        self.urls: list[str] = []
+        self.added: list[Callable] = []
+        self.url: str | None = None
+        self.updated: Callable | None = None
+
+
+class RoomBatcher:
+    # Collects the playlist additions and the video changes of a room for `window` seconds, then sends a single
+    # add_items request and only the latest update
+    def __init__(self, plugin: WatchTogether, window: float = 0.5):
+        self.plugin = plugin
+        self.window = window
+        self.batches: Dict[str, Batch] = {}
+        self.lock = Lock()
+
+    def _batch(self, room: str) -> Batch:
+        batch = self.batches.get(room)
+        if batch is None:
+            batch = self.batches[room] = Batch()
+            timer = Timer(self.window, self.flush, [room])
+            timer.daemon = True
+            timer.start()
+        return batch
+
+    def add(self, room: str, urls: list[str], done: Callable):
+        with self.lock:
+            batch = self._batch(room)
+            batch.urls.extend(urls)
+            batch.added.append(done)
+
+    def update(self, room: str, url: str, done: Callable):
+        with self.lock:
+            batch = self._batch(room)
+            # Superseded updates are dropped without a reply, the latest one announces the video
+            batch.url = url
+            batch.updated = done
+
+    def flush(self, room: str):
+        client = self.plugin.client
+        token = self.plugin.api_token
+        # Queued before the lock is released, so the room is never seen with nothing batched nor queued
+        with self.lock:
+            batch = self.batches.pop(room, None)
+            if not batch:
+                return
+            if batch.url is not None:
+                url = batch.url
+                self.plugin.executor.submit(room, lambda: client.update(room, token, url), batch.updated)
+            if batch.urls:
+                videos = [{"url": item, "title": num} for num, item in enumerate(batch.urls)]
+
+                def added(res: requests.Response | None):
+                    # Every command in the batch gets its own reply
+                    for done in batch.added:
+                        done(res)
+
+                self.plugin.executor.submit(room, lambda: client.add_items(room, token, videos), added)
+
+
+class Room:
+    __slots__ = ("id", "channel", "users", "last_used")
+
+    def __init__(self, _id: str, channel: str, now: float):
+        self.id = _id
+        self.channel = channel
+        # Users that created or used the room
+        self.users: set[str] = set()
+        self.last_used = now
+
+    @property
+    def url(self) -> str:
+        return f"https://w2g.tv/rooms/{self.id}"
+
+
+class RoomRegistry:
+    # Rooms ordered from the least to the most recently used, idle ones are expired from the front. A room is
+    # reachable from its channel and from each of its users, and is dropped when the last of them leaves
+    def __init__(self, ttl: float):
+        self.ttl = ttl
+        self.rooms: OrderedDict[str, Room] = OrderedDict()
+        self.channels: Dict[str, Room] = {}
+        self.users: Dict[str, Room] = {}
+        self.lock = Lock()
+
+    def get(self, channel: str, now: float) -> Room | None:
+        self.expire(now)
+        return self.channels.get(channel)
+
+    def add(self, _id: str, channel: str, user: str, now: float) -> Room:
+        previous = self.channels.get(channel)
+        if previous:
+            self.drop(previous)
+        room = Room(_id, channel, now)
+        self.rooms[_id] = room
+        self.channels[channel] = room
+        self.use(room, user, now)
+        return room
+
+    def use(self, room: Room, user: str, now: float):
+        if self.users.get(user) is not room:
+            self.release(user)
+            room.users.add(user)
+            self.users[user] = room
+        room.last_used = now
+        self.rooms.move_to_end(room.id)
+
+    def release(self, user: str):
+        room = self.users.pop(user, None)
+        if room:
+            room.users.discard(user)
+            if not room.users:
+                self.drop(room)
+
+    def move(self, user: str, channel: str, now: float) -> Room | None:
+        # The room follows its only user to a channel without a room, otherwise the user leaves it
+        room = self.users.get(user)
+        if not room or room.channel == channel:
+            return None
+        if len(room.users) == 1 and channel not in self.channels:
+            del self.channels[room.channel]
+            room.channel = channel
+            self.channels[channel] = room
+            room.last_used = now
+            self.rooms.move_to_end(room.id)
+            return room
+        self.release(user)
+        return None
+
+    def drop(self, room: Room):
+        self.rooms.pop(room.id, None)
+        if self.channels.get(room.channel) is room:
+            del self.channels[room.channel]
+        for user in room.users:
+            if self.users.get(user) is room:
+                del self.users[user]
+        room.users.clear()
+
+    def expire(self, now: float):
+        rooms = self.rooms
+        while rooms:
+            oldest = next(iter(rooms.values()))
+            if now - oldest.last_used < self.ttl:
+                return
+            self.drop(oldest)
 
 
 class WatchTogether(Plugin):
     def __init__(self):
         super().__init__("w2g", "Watch Together", "Permits you to create a watch together session from the chat", ["nico9889"])
-        self.channel_room: dict[str, str] = {}
-        self.user_channel: dict[str, str] = {}
+        self.rooms = RoomRegistry(120 * 60)
         self.api_token_option = None
+        self.client = W2GClient()
+        self.executor = RoomExecutor()
+        self.batcher = RoomBatcher(self)
         self.add_command(Token(self))
         self.add_command(Color(self))
         self.add_command(Create(self))
@@ -39,6 +281,22 @@ class WatchTogether(Plugin):
         self.api_token_option = ApiTokenOption(self)
         self.api_token_option.on_change = lambda value: setattr(self, "api_token_option", value) or True
         self.options.add(self.api_token_option)
+        self.client.api_url = self.api_url
+        api_url_option = StringOption("W2G API URL", "Address of the W2G API, change it only to use another server",
+                                      self.api_url)
+        api_url_option.on_change = lambda value: self.set_api_url(value)
+        self.options.add(api_url_option)
+        self.batcher.window = self.batch_window / 1000
+        batch_window_option = NumberOption("Batch window", "Milliseconds during which !update and !addplaylist on "
+                                                           "the same room are merged in a single request",
+                                           self.batch_window, 0, 5000, 100)
+        batch_window_option.on_change = lambda value: self.set_batch_window(int(value))
+        self.options.add(batch_window_option)
+        self.rooms.ttl = self.room_expiry * 60
+        room_expiry_option = NumberOption("Room expiry", "Minutes after which an unused room is forgotten and "
+                                                         "!create makes a new one", self.room_expiry, 1, 1440, 1)
+        room_expiry_option.on_change = lambda value: self.set_room_expiry(int(value))
+        self.options.add(room_expiry_option)
 
     @property
     def api_token(self):
@@ -48,6 +306,59 @@ class WatchTogether(Plugin):
     def api_token(self, value: str):
         self.instance_storage["api_token"] = value
 
+    @property
+    def api_url(self) -> str:
+        return self.instance_storage.get("api_url") or API_URL
+
+    @api_url.setter
+    def api_url(self, value: str):
+        self.instance_storage["api_url"] = value
+
+    def set_api_url(self, value: str) -> bool:
+        if not value.startswith(("http://", "https://")):
+            return False
+        self.api_url = value
+        self.client.api_url = value
+        return True
+
+    @property
+    def batch_window(self) -> int:
+        batch_window = self.instance_storage.get("batch_window")
+        return 500 if batch_window is None else batch_window
+
+    @batch_window.setter
+    def batch_window(self, value: int):
+        self.instance_storage["batch_window"] = value
+
+    def set_batch_window(self, value: int) -> bool:
+        self.batch_window = value
+        self.batcher.window = value / 1000
+        return True
+
+    @property
+    def room_expiry(self) -> int:
+        return self.instance_storage.get("room_expiry") or 120
+
+    @room_expiry.setter
+    def room_expiry(self, value: int):
+        self.instance_storage["room_expiry"] = value
+
+    def set_room_expiry(self, value: int) -> bool:
+        if value < 1:
+            return False
+        self.room_expiry = value
+        self.rooms.ttl = value * 60
+        return True
+
+    def room(self, ctx: Context) -> Room | None:
+        # The room of the user channel, now used by the user too
+        now = monotonic()
+        with self.rooms.lock:
+            room = self.rooms.get(ctx.user.current_channel().id(), now)
+            if room:
+                self.rooms.use(room, ctx.user.id(), now)
+            return room
+
     @property
     def colors(self) -> Dict[str, str]:
         return self.instance_storage.get("colors") or {}
@@ -57,17 +368,14 @@ class WatchTogether(Plugin):
         self.instance_storage["colors"] = colors
 
     def on_user_leaved(self, ctx: Context):
-        if ctx.user.id() in self.user_channel:
-            channel = self.user_channel.pop(ctx.user.id())
-            del self.channel_room[channel]
+        with self.rooms.lock:
+            self.rooms.release(ctx.user.id())
 
     def on_user_moved(self, ctx: Context, channel: ContextChannel, actor: ContextUser):
-        if ctx.user.id() in self.user_channel:
-            c = self.user_channel.pop(ctx.user.id())
-            room = self.channel_room.pop(c)
-            self.channel_room[channel.id()] = room
-            self.user_channel[ctx.user.id()] = channel.id()
-            message = ctx.message.bold("W2G: ").text(f"Room {room} is now tied to ").bold(channel.name())
+        with self.rooms.lock:
+            room = self.rooms.move(ctx.user.id(), channel.id(), monotonic())
+        if room:
+            message = ctx.message.bold("W2G: ").text(f"Room {room.id} is now tied to ").bold(channel.name())
             message.send_to_channel(ctx.user.current_channel())
             message.send_to_channel(channel)
 
@@ -108,24 +416,39 @@ class Create(Command):
             return ctx.message.text(
                 "Missing W2G API Token. Please use !token <token> to set an API token", color=Colors.RED) \
                 .reply_to_channel()
+        room = self.plugin.room(ctx)
+        if room:
+            # The channel has a room already, no need for a new one
+            ctx.message.text(ctx.user.name()).text(" joined the ").hypertext("room", room.url).text("!") \
+                .reply_to_channel()
+            if message:
+                self.plugin.batcher.update(room.id, message, lambda res: updated(ctx, message, res))
+            return
         color = self.plugin.colors[ctx.user.id()] if ctx.user.id() in self.plugin.colors else "#6f6f6f"
-        res = requests.post("https://api.w2g.tv/rooms/create.json", headers=HEADERS, json={
-            "w2g_api_key": token,
-            "share": message,
-            "bg_color": color,
-            "bg_opacity": "100"
-        })
-        if not res.ok:
-            return ctx.message.text("Failed to create room", color=Colors.RED).reply_to_channel()
-        data = res.json()
-        if "streamkey" not in data:
-            return ctx.message.text("W2G returned an invalid response", color=Colors.RED).reply_to_channel()
+        channel = ctx.user.current_channel().id()
+        user = ctx.user.id()
 
-        ctx.message.text(ctx.user.name()).text(" created a new ") \
-            .hypertext("room", f"https://w2g.tv/rooms/{data['streamkey']}") \
-            .text("!").reply_to_channel()
-        self.plugin.channel_room[ctx.user.current_channel().id()] = data['streamkey']
-        self.plugin.user_channel[ctx.user.id()] = ctx.user.current_channel().id()
+        def done(res: requests.Response | None):
+            if res is None or not res.ok:
+                return ctx.message.text("Failed to create room", color=Colors.RED).reply_to_channel()
+            data = res.json()
+            if "streamkey" not in data:
+                return ctx.message.text("W2G returned an invalid response", color=Colors.RED).reply_to_channel()
+
+            with self.plugin.rooms.lock:
+                room = self.plugin.rooms.add(data['streamkey'], channel, user, monotonic())
+            ctx.message.text(ctx.user.name()).text(" created a new ") \
+                .hypertext("room", room.url) \
+                .text("!").reply_to_channel()
+
+        # No room yet, the channel orders the creations
+        self.plugin.executor.submit(channel, lambda: self.plugin.client.create(token, message, color), done)
+
+
+def updated(ctx: Context, message: str, res: requests.Response | None):
+    if res is None or not res.ok:
+        return ctx.message.text("Failed to update the room", color=Colors.RED).reply_to_channel()
+    ctx.message.text(ctx.user.name()).text(" changed the video to ").text(message).reply_to_channel()
 
 
 class Update(Command):
@@ -134,16 +457,10 @@ class Update(Command):
         self.plugin = p
 
     def execute(self, ctx: Context, message: str):
-        room = self.plugin.channel_room.get(ctx.user.current_channel().id())
+        room = self.plugin.room(ctx)
         if not room:
             return ctx.message.text("No room has been created in this channel", color=Colors.RED).reply_to_user()
-        res = requests.post(f"https://api.w2g.tv/rooms/{room}/sync_update", headers=HEADERS, json={
-            "w2g_api_key": self.plugin.api_token,
-            "item_url": message
-        })
-        if not res.ok:
-            return ctx.message.text("Failed to update the room", color=Colors.RED).reply_to_channel()
-        ctx.message.text(ctx.user.name()).text(" changed the video to ").text(message).reply_to_channel()
+        self.plugin.batcher.update(room.id, message, lambda res: updated(ctx, message, res))
 
 
 class AddPlaylist(Command):
@@ -154,28 +471,18 @@ class AddPlaylist(Command):
 
     def execute(self, ctx: Context, message: str):
         chunks = message.split(" ")
-        videos = []
-        for num, chunk in enumerate(chunks):
-            video = {
-                "url": chunk,
-                "title": num
-            }
-            videos.append(video)
-        room = self.plugin.channel_room.get(ctx.user.current_channel().id())
+        room = self.plugin.room(ctx)
         if not room:
             return ctx.message.text("No room has been created in this channel", color=Colors.RED).reply_to_user()
-        res = requests.post(f"https://api.w2g.tv/rooms/{room}/playlists/current/playlist_items/sync_update",
-                            headers=HEADERS,
-                            json={
-                                "w2g_api_key": self.plugin.api_token,
-                                "add_items": videos
-                            })
-        if not res.ok:
-            return ctx.message.text("Failed to update the room", color=Colors.RED).reply_to_channel()
-        _list = ctx.message.text(ctx.user.name()).text(" added the following videos to the room: ").list()
-        for chunk in chunks:
-            _list = _list.add(chunk)
-        _list.close().reply_to_channel()
+        def done(res: requests.Response | None):
+            if res is None or not res.ok:
+                return ctx.message.text("Failed to update the room", color=Colors.RED).reply_to_channel()
+            _list = ctx.message.text(ctx.user.name()).text(" added the following videos to the room: ").list()
+            for chunk in chunks:
+                _list = _list.add(chunk)
+            _list.close().reply_to_channel()
+
+        self.plugin.batcher.add(room.id, chunks, done)
 
 
 class Color(Command):
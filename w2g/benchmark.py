@@ -0,0 +1,164 @@
+from __future__ import annotations
+
+import argparse
+import random
+import time
+from typing import List
+
+from . import AddPlaylist, Create, Update, WatchTogether
+from .stub import W2GStub
+
+
+class Record:
+    __slots__ = ("kind", "issued", "handled", "replied", "failed")
+
+    def __init__(self, kind: str):
+        self.kind = kind
+        self.issued = time.perf_counter()
+        self.handled = 0.0
+        self.replied = 0.0
+        self.failed = False
+
+
+class StubMessage:
+    # Every chained call returns the message, the reply marks the command as answered
+    def __init__(self, record: Record):
+        self.record = record
+        self.failed = False
+
+    def text(self, *args, color=None, **kwargs) -> StubMessage:
+        self.failed = self.failed or color is not None
+        return self
+
+    def reply_to_channel(self):
+        if not self.record.replied:
+            self.record.failed = self.failed
+            self.record.replied = time.perf_counter()
+
+    reply_to_user = reply_to_channel
+
+    def __getattr__(self, _):
+        return lambda *args, **kwargs: self
+
+
+class StubChannel:
+    def __init__(self, _id: str):
+        self._id = _id
+
+    def id(self) -> str:
+        return self._id
+
+    def name(self) -> str:
+        return self._id
+
+
+class StubUser:
+    def __init__(self, _id: str, channel: StubChannel):
+        self._id = _id
+        self.channel = channel
+
+    def id(self) -> str:
+        return self._id
+
+    def name(self) -> str:
+        return f"user{self._id}"
+
+    def current_channel(self) -> StubChannel:
+        return self.channel
+
+
+class StubContext:
+    def __init__(self, user: StubUser, record: Record):
+        self.user = user
+        self.message = StubMessage(record)
+
+
+def percentile(values: List[float], p: float) -> float:
+    return values[min(len(values) - 1, int(len(values) * p))] * 1000 if values else 0.0
+
+
+def idle(plugin: WatchTogether) -> bool:
+    with plugin.batcher.lock, plugin.executor.lock:
+        return not plugin.batcher.batches and not plugin.executor.queues
+
+
+def drive(plugin: WatchTogether, workload: List[tuple[str, StubUser, str]], timeout: float) -> List[Record]:
+    commands = {"create": Create(plugin), "update": Update(plugin), "addplaylist": AddPlaylist(plugin)}
+    records = []
+    for kind, user, message in workload:
+        record = Record(kind)
+        commands[kind].execute(StubContext(user, record), message)
+        record.handled = time.perf_counter()
+        records.append(record)
+    # Superseded updates never get a reply, wait until nothing is batched or queued anymore
+    deadline = time.perf_counter() + timeout
+    while not idle(plugin) and time.perf_counter() < deadline:
+        time.sleep(0.005)
+    return records
+
+
+def report(name: str, records: List[Record], elapsed: float):
+    print(f"{name}: {len(records)} commands in {elapsed:.3f}s")
+    for kind in sorted({record.kind for record in records}):
+        of_kind = [record for record in records if record.kind == kind]
+        handled = sorted(record.handled - record.issued for record in of_kind)
+        replied = sorted(record.replied - record.issued for record in of_kind if record.replied)
+        failed = sum(1 for record in of_kind if record.failed)
+        print(f"  {kind:>11}: handler p50 {percentile(handled, 0.5):.2f}ms p99 {percentile(handled, 0.99):.2f}ms  "
+              f"reply p50 {percentile(replied, 0.5):.1f}ms p95 {percentile(replied, 0.95):.1f}ms "
+              f"p99 {percentile(replied, 0.99):.1f}ms  {len(replied)} replied, {failed} failed, "
+              f"{len(of_kind) - len(replied)} collapsed")
+
+
+def run(args: argparse.Namespace):
+    rng = random.Random(args.seed)
+    server = W2GStub(("127.0.0.1", 0), args.latency, args.jitter, args.error_rate, args.seed).start()
+    plugin = WatchTogether()
+    plugin.api_token = "benchmark"
+    plugin.api_url = server.url
+    plugin.on_load(None)
+    plugin.set_batch_window(args.window)
+    users = [StubUser(str(i), StubChannel(f"channel{i}")) for i in range(args.rooms)]
+
+    started = time.perf_counter()
+    created = drive(plugin, [("create", user, "https://example.com/0") for user in users], args.timeout)
+    report("Create", created, time.perf_counter() - started)
+
+    workload = []
+    for n in range(args.commands):
+        user = rng.choice(users)
+        if rng.random() < args.update_ratio:
+            workload.append(("update", user, f"https://example.com/{n}"))
+        else:
+            urls = " ".join(f"https://example.com/{n}/{i}" for i in range(rng.randint(1, 3)))
+            workload.append(("addplaylist", user, urls))
+    server.requests.clear()
+    started = time.perf_counter()
+    records = drive(plugin, workload, args.timeout)
+    elapsed = time.perf_counter() - started
+    report("Update/AddPlaylist", records, elapsed)
+
+    requests = sum(server.requests.values())
+    print(f"Server: {requests} requests ({requests / elapsed if elapsed else 0:.0f}/s) for {len(records)} "
+          f"commands, " + ", ".join(f"{endpoint} {n}" for endpoint, n in sorted(server.requests.items())) +
+          f", {sum(server.errors.values())} injected errors")
+    server.shutdown()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Drive the W2G commands against a local stub of the W2G API and "
+                                                 "report command latency and request throughput")
+    parser.add_argument("--rooms", type=int, default=20)
+    parser.add_argument("--commands", type=int, default=2000, help="!update and !addplaylist commands")
+    parser.add_argument("--update-ratio", type=float, default=0.5, help="fraction of the commands that are !update")
+    parser.add_argument("--latency", type=float, default=0.05, help="stub seconds before every answer")
+    parser.add_argument("--jitter", type=float, default=0.02)
+    parser.add_argument("--error-rate", type=float, default=0.0, help="fraction of the stub answers that are 503")
+    parser.add_argument("--window", type=int, default=500, help="batch window in milliseconds")
+    parser.add_argument("--timeout", type=float, default=60, help="seconds to wait for the replies")
+    parser.add_argument("--seed", type=int, default=0)
+    run(parser.parse_args())
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,125 @@
+from __future__ import annotations
+
+import argparse
+import json
+import random
+import re
+import time
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from threading import Lock, Thread
+
+CREATE = re.compile(r"^/rooms/create\.json$")
+UPDATE = re.compile(r"^/rooms/(?P<room>\w+)/sync_update$")
+PLAYLIST = re.compile(r"^/rooms/(?P<room>\w+)/playlists/current/playlist_items/sync_update$")
+
+
+class W2GStub(ThreadingHTTPServer):
+    # Local stand-in for api.w2g.tv, answers after `latency` (+- `jitter`) seconds and fails `error_rate` of the
+    # requests with a 503
+    daemon_threads = True
+
+    def __init__(self, address: tuple[str, int], latency: float = 0.0, jitter: float = 0.0,
+                 error_rate: float = 0.0, seed: int | None = None):
+        super().__init__(address, W2GHandler)
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.random = random.Random(seed)
+        self.lock = Lock()
+        self.requests = Counter()
+        self.errors = Counter()
+        self.rooms: dict[str, dict] = {}
+
+    @property
+    def url(self) -> str:
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def start(self) -> W2GStub:
+        Thread(target=self.serve_forever, name="W2GStub", daemon=True).start()
+        return self
+
+    def delay(self) -> float:
+        with self.lock:
+            return max(0.0, self.latency + self.random.uniform(-self.jitter, self.jitter))
+
+    def fail(self, endpoint: str) -> bool:
+        with self.lock:
+            self.requests[endpoint] += 1
+            failed = self.random.random() < self.error_rate
+            if failed:
+                self.errors[endpoint] += 1
+            return failed
+
+
+class W2GHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    server: W2GStub
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        try:
+            body = json.loads(self.rfile.read(length) or b"{}")
+        except ValueError:
+            return self.reply(400, {"error": "invalid json"})
+        if not body.get("w2g_api_key"):
+            return self.reply(403, {"error": "missing api key"})
+        if CREATE.match(self.path):
+            endpoint = "create"
+        elif UPDATE.match(self.path):
+            endpoint = "update"
+        elif PLAYLIST.match(self.path):
+            endpoint = "playlist"
+        else:
+            return self.reply(404, {"error": "not found"})
+        time.sleep(self.server.delay())
+        if self.server.fail(endpoint):
+            return self.reply(503, {"error": "injected failure"})
+        with self.server.lock:
+            if endpoint == "create":
+                room = f"{self.server.random.getrandbits(64):016x}"
+                self.server.rooms[room] = {"url": body.get("share"), "items": []}
+                return self.reply(200, {"streamkey": room})
+            room = self.server.rooms.get((UPDATE.match(self.path) or PLAYLIST.match(self.path))["room"])
+            if room is None:
+                return self.reply(404, {"error": "unknown room"})
+            if endpoint == "update":
+                room["url"] = body.get("item_url")
+            else:
+                room["items"].extend(body.get("add_items") or [])
+        self.reply(200, {})
+
+    def reply(self, status: int, data: dict):
+        out = json.dumps(data).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(out)))
+        self.end_headers()
+        self.wfile.write(out)
+
+    def log_message(self, format: str, *args):
+        pass
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Serve a local stand-in of the W2G API")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--latency", type=float, default=0.0, help="seconds before every answer")
+    parser.add_argument("--jitter", type=float, default=0.0, help="random +- seconds added to the latency")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="fraction of the requests answered with a 503")
+    parser.add_argument("--seed", type=int, default=None)
+    args = parser.parse_args()
+    server = W2GStub((args.host, args.port), args.latency, args.jitter, args.error_rate, args.seed)
+    print(f"W2G stub listening on {server.url}, set it as the W2G API URL of the plugin")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        print("Requests: " + ", ".join(f"{endpoint} {n}" for endpoint, n in server.requests.items()))
+
+
+if __name__ == "__main__":
+    main()